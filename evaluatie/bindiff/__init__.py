@@ -0,0 +1,13 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+from .bindiff import BinDiffResult, CandidateFilter, SimilarityMatrix, bindiff, neighbsim_matrix
+
+__all__ = [
+    "bindiff",
+    "BinDiffResult",
+    "CandidateFilter",
+    "SimilarityMatrix",
+    "neighbsim_matrix",
+]
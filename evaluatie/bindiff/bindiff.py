@@ -0,0 +1,369 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import array
+import typing
+
+import msgspec
+import networkx as nx
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import sqlalchemy as sa
+from scipy.sparse.csgraph import connected_components, min_weight_full_bipartite_matching
+
+from evaluatie import utils
+from evaluatie.neighbsim.neighbsim import NeighBSimArgs, neighbsim
+
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
+
+class CandidateFilter(msgspec.Struct, frozen=True):
+    """Selects the function pairs that SimilarityMatrix.from_pair transfers from the database.
+    The filter is applied in the database, so that big binaries do not transfer
+    their (almost) dense similarity matrix.
+    """
+
+    #: Only similarities strictly above threshold are transferred
+    threshold: float = 0.0
+    #: Only pairs that are among the top_k most similar pairs of their query or of their
+    #: target function are transferred (see SimilarityMatrix.top_k). None transfers all pairs.
+    top_k: int | None = 32
+
+
+_FUNCTIONS_WITH_VECTOR = """
+WITH qf AS MATERIALIZED (
+	SELECT f.id, f.vector
+	FROM e."function:all" f
+	WHERE f.binary_id = :qb_id AND f.vector IS NOT NULL
+),
+tf AS MATERIALIZED (
+	SELECT f.id, f.vector
+	FROM e."function:all" f
+	WHERE f.binary_id = :tb_id AND f.vector IS NOT NULL
+)
+"""
+
+_ALL_PAIRS_STATEMENT = _FUNCTIONS_WITH_VECTOR + """
+SELECT qf.id AS qf_id, tf.id AS tf_id, sim.bsim
+FROM qf
+	CROSS JOIN tf
+	CROSS JOIN LATERAL (
+		SELECT COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0) AS bsim
+	) sim
+WHERE sim.bsim > :threshold
+"""
+
+# Every function's top k are selected by a LATERAL subquery with a LIMIT,
+# which Postgres computes with a bounded top-k sort per function instead of
+# sorting the whole cross product like a window function would.
+# The similarities are deterministic, so UNION removes pairs that both sides selected.
+_TOP_K_PAIRS_STATEMENT = _FUNCTIONS_WITH_VECTOR + """
+SELECT qf.id AS qf_id, best.tf_id, best.bsim
+FROM qf
+	CROSS JOIN LATERAL (
+		SELECT tf.id AS tf_id, sim.bsim
+		FROM tf
+			CROSS JOIN LATERAL (
+				SELECT COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0) AS bsim
+			) sim
+		WHERE sim.bsim > :threshold
+		ORDER BY sim.bsim DESC, tf.id
+		LIMIT :top_k
+	) best
+UNION
+SELECT best.qf_id, tf.id AS tf_id, best.bsim
+FROM tf
+	CROSS JOIN LATERAL (
+		SELECT qf.id AS qf_id, sim.bsim
+		FROM qf
+			CROSS JOIN LATERAL (
+				SELECT COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0) AS bsim
+			) sim
+		WHERE sim.bsim > :threshold
+		ORDER BY sim.bsim DESC, qf.id
+		LIMIT :top_k
+	) best
+"""
+
+
+class SimilarityMatrix(msgspec.Struct):
+    """Sparse similarities between the functions of two binaries.
+    Rows are query functions, columns are target functions.
+    Pairs that are not stored have a similarity of zero and are never matched.
+    """
+
+    query_function_ids: np.ndarray
+    target_function_ids: np.ndarray
+    #: Shape is (len(query_function_ids), len(target_function_ids))
+    matrix: sp.csr_array
+
+    @classmethod
+    def from_graph(
+        cls,
+        similarity_graph: nx.Graph,
+        query_function_ids: list[int],
+        target_function_ids: list[int],
+    ) -> "SimilarityMatrix":
+        """Converts a (bipartite) similarity graph, e.g. from
+        utils.similarity_graph_from_pair, to a sparse matrix.
+        """
+        query_function_ids = np.asarray(query_function_ids, dtype=np.int64)
+        target_function_ids = np.asarray(target_function_ids, dtype=np.int64)
+        entries = utils.similarity_graph_entries(
+            similarity_graph,
+            query_function_ids.tolist(),
+            target_function_ids.tolist(),
+        )
+
+        return cls._from_coo(query_function_ids, target_function_ids, entries)
+
+    @classmethod
+    def from_pair(
+        cls,
+        qb_id: int,
+        tb_id: int,
+        session: "m.Session",
+        candidates: CandidateFilter = CandidateFilter(),
+    ) -> "SimilarityMatrix":
+        """Calculates the similarity of all functions in the binary pair.
+        Only the pairs that candidates selects are transferred from the database,
+        which keeps the matrix sparse for big binaries.
+        """
+        ids_stmt = sa.text(
+            """
+            SELECT f.id
+            FROM e."function:all" f
+            WHERE f.binary_id = :binary_id AND f.vector IS NOT NULL
+            ORDER BY f.id
+            """
+        )
+        query_function_ids = np.fromiter(
+            session.scalars(ids_stmt, {"binary_id": qb_id}),
+            dtype=np.int64,
+        )
+        target_function_ids = np.fromiter(
+            session.scalars(ids_stmt, {"binary_id": tb_id}),
+            dtype=np.int64,
+        )
+
+        stmt = sa.text(
+            _ALL_PAIRS_STATEMENT if candidates.top_k is None else _TOP_K_PAIRS_STATEMENT
+        )
+        qid2idx = {qid: idx for idx, qid in enumerate(query_function_ids.tolist())}
+        tid2idx = {tid: idx for idx, tid in enumerate(target_function_ids.tolist())}
+
+        rows = array.array("q")
+        cols = array.array("q")
+        data = array.array("d")
+        result = session.execute(
+            stmt,
+            {
+                "qb_id": qb_id,
+                "tb_id": tb_id,
+                "threshold": candidates.threshold,
+                "top_k": candidates.top_k,
+            },
+            execution_options={"yield_per": 100_000},
+        )
+        for qf_id, tf_id, bsim in result:
+            rows.append(qid2idx[qf_id])
+            cols.append(tid2idx[tf_id])
+            data.append(bsim)
+
+        return cls._from_coo(query_function_ids, target_function_ids, (rows, cols, data))
+
+    @classmethod
+    def _from_coo(cls, query_function_ids, target_function_ids, entries):
+        """entries are the rows, columns and similarities as arrays."""
+        rows, cols, data = entries
+        matrix = sp.csr_array(
+            (
+                np.frombuffer(data, dtype=np.float64),
+                (np.frombuffer(rows, dtype=np.int64), np.frombuffer(cols, dtype=np.int64)),
+            ),
+            shape=(len(query_function_ids), len(target_function_ids)),
+        )
+        return cls(
+            query_function_ids=query_function_ids,
+            target_function_ids=target_function_ids,
+            matrix=matrix,
+        )
+
+    def thresholded(self, threshold: float) -> "SimilarityMatrix":
+        """Drops all entries with a similarity of at most threshold."""
+        coo = self.matrix.tocoo()
+        keep = coo.data > threshold
+        return self._with_entries(coo.row[keep], coo.col[keep], coo.data[keep])
+
+    def top_k(self, k: int) -> "SimilarityMatrix":
+        """Keeps an entry if it is among the k most similar entries of its row or of its column."""
+        coo = self.matrix.tocoo()
+        keep = _top_k_mask(coo.row, coo.data, k) | _top_k_mask(coo.col, coo.data, k)
+        return self._with_entries(coo.row[keep], coo.col[keep], coo.data[keep])
+
+    def _with_entries(self, rows, cols, data) -> "SimilarityMatrix":
+        return SimilarityMatrix(
+            query_function_ids=self.query_function_ids,
+            target_function_ids=self.target_function_ids,
+            matrix=sp.csr_array((data, (rows, cols)), shape=self.matrix.shape),
+        )
+
+
+class BinDiffResult(msgspec.Struct):
+    #: One row per matched pair.
+    #: Columns are query_function_id, target_function_id and score.
+    matches: pd.DataFrame
+    unmatched_query_function_ids: np.ndarray
+    unmatched_target_function_ids: np.ndarray
+
+    #: Number of independent assignment problems that were solved
+    component_count: int
+
+
+def bindiff(
+    similarity: SimilarityMatrix,
+    threshold: float = 0.0,
+    top_k: int | None = None,
+    split_components: bool = True,
+) -> BinDiffResult:
+    """Computes a global one-to-one assignment of query to target functions
+    that maximizes the summed similarity.
+
+    Pairs with a similarity of at most threshold are never matched.
+    If top_k is given, only the top_k most similar candidates of every function are considered,
+    which keeps the assignment problem sparse for binaries with many functions.
+    If split_components is set, every connected component of the candidate graph is
+    solved as its own (smaller) assignment problem.
+    The summed similarity of the matching is the same either way.
+    """
+    # Pairs without similarity do not contribute to the matching
+    similarity = similarity.thresholded(max(threshold, 0.0))
+    if top_k is not None:
+        similarity = similarity.top_k(top_k)
+
+    coo = similarity.matrix.tocoo()
+    n_query, n_target = coo.shape
+
+    if coo.nnz == 0:
+        components = []
+    elif split_components:
+        components = _components(coo.row, coo.col, n_query, n_target)
+    else:
+        components = [np.arange(coo.nnz)]
+
+    matched_edges = [
+        edges[_max_weight_matching(coo.row[edges], coo.col[edges], coo.data[edges])]
+        for edges in components
+    ]
+    edges = np.concatenate(matched_edges) if matched_edges else np.empty(0, dtype=np.int64)
+    edges = edges[np.argsort(coo.row[edges], kind="stable")]
+    rows = coo.row[edges]
+    cols = coo.col[edges]
+
+    matches = pd.DataFrame(
+        {
+            "query_function_id": similarity.query_function_ids[rows],
+            "target_function_id": similarity.target_function_ids[cols],
+            "score": coo.data[edges],
+        }
+    )
+
+    query_unmatched = np.ones(n_query, dtype=bool)
+    query_unmatched[rows] = False
+    target_unmatched = np.ones(n_target, dtype=bool)
+    target_unmatched[cols] = False
+
+    return BinDiffResult(
+        matches=matches,
+        unmatched_query_function_ids=similarity.query_function_ids[query_unmatched],
+        unmatched_target_function_ids=similarity.target_function_ids[target_unmatched],
+        component_count=len(components),
+    )
+
+
+def neighbsim_matrix(candidates: SimilarityMatrix, args: NeighBSimArgs) -> SimilarityMatrix:
+    """Rescores every stored entry of candidates with neighbsim.
+    Use a thresholded or top_k matrix as candidates, as scoring all pairs is quadratic.
+    """
+    coo = candidates.matrix.tocoo()
+    data = np.fromiter(
+        (
+            neighbsim(qf_id, tf_id, args).score
+            for qf_id, tf_id in zip(
+                candidates.query_function_ids[coo.row].tolist(),
+                candidates.target_function_ids[coo.col].tolist(),
+            )
+        ),
+        dtype=np.float64,
+        count=coo.nnz,
+    )
+
+    return candidates._with_entries(coo.row, coo.col, data)
+
+
+def _top_k_mask(keys: np.ndarray, weights: np.ndarray, k: int) -> np.ndarray:
+    """Returns a mask that selects the k highest weights for every key."""
+    order = np.lexsort((-weights, keys))
+    sorted_keys = keys[order]
+    group_start = np.searchsorted(sorted_keys, sorted_keys, side="left")
+    rank = np.arange(len(keys)) - group_start
+
+    mask = np.empty(len(keys), dtype=bool)
+    mask[order] = rank < k
+    return mask
+
+
+def _components(rows: np.ndarray, cols: np.ndarray, n_query: int, n_target: int):
+    """Returns the edge indices of every connected component that has at least one edge."""
+    adjacency = sp.coo_array(
+        (np.ones(len(rows), dtype=np.int8), (rows, n_query + cols)),
+        shape=(n_query + n_target, n_query + n_target),
+    )
+    _, labels = connected_components(adjacency, directed=False)
+    edge_labels = labels[rows]
+
+    order = np.argsort(edge_labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(edge_labels[order])) + 1
+    return np.split(order, boundaries) if len(order) else []
+
+
+def _max_weight_matching(rows: np.ndarray, cols: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Returns the indices of the edges in a maximum weight (not necessarily full) matching
+    of a sparse bipartite graph.
+
+    Scipy only solves matchings that match every row, so every row gets a dummy column.
+    Matching a row to its dummy means leaving it unmatched.
+    As every such matching has the same number of edges, shifting all costs by a constant
+    does not change the optimum but keeps all costs positive (zero means "no edge" to scipy).
+    """
+    if len(rows) == 1:
+        return np.zeros(1, dtype=np.int64)
+
+    row_idx, local_rows = np.unique(rows, return_inverse=True)
+    col_idx, local_cols = np.unique(cols, return_inverse=True)
+    n_rows = len(row_idx)
+    n_cols = len(col_idx)
+    shift = weights.max() + 1
+
+    biadjacency = sp.csr_array(
+        (
+            np.concatenate([shift - weights, np.full(n_rows, shift)]),
+            (
+                np.concatenate([local_rows, np.arange(n_rows)]),
+                np.concatenate([local_cols, n_cols + np.arange(n_rows)]),
+            ),
+        ),
+        shape=(n_rows, n_cols + n_rows),
+    )
+    row_ind, col_ind = min_weight_full_bipartite_matching(biadjacency)
+
+    real = col_ind < n_cols
+    # Map the matched pairs back to edge indices
+    edge_keys = local_rows * n_cols + local_cols
+    order = np.argsort(edge_keys)
+    matched_keys = row_ind[real] * n_cols + col_ind[real]
+    return order[np.searchsorted(edge_keys, matched_keys, sorter=order)]
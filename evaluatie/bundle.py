@@ -0,0 +1,365 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""Bundles contain everything that is needed to score datasets without a database.
+
+A bundle is a zip file with
+- manifest.json, see BundleManifest,
+- datasets/{index}.pickle, the massaged frames of the datasets (see FunctionDataset),
+- call-graphs/{binary_id}.npz, the call-graphs of all binaries of the datasets,
+- similarity/{qb_id}-{tb_id}.npz, the similarities that neighbsim needs for the binary pair,
+- firmup/{qb_id}-{tb_id}.npz, the similarities of all functions of the binary pair (optional).
+"""
+
+import functools
+import io
+import pathlib as pl
+import typing
+import zipfile
+
+import msgspec
+import networkx as nx
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from tqdm import tqdm
+
+from evaluatie import scoring, utils
+from evaluatie.data import FunctionDataset
+from evaluatie.firmup.firmup import FirmUPArgs, firmup_batch
+from evaluatie.neighbsim.matching import MatchingOptions
+
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
+BUNDLE_VERSION = 1
+
+
+class BundleManifest(msgspec.Struct, frozen=True):
+    version: int
+    datasets: list[str]
+    binary_ids: list[int]
+    #: Binary pairs that have the similarities for neighbsim
+    binary_pairs: list[tuple[int, int]]
+    #: Binary pairs that have the similarities for firmup
+    firmup_binary_pairs: list[tuple[int, int]]
+
+
+class _ExportingSource:
+    """Wraps a DatabaseSource and writes everything that scoring requests to the bundle."""
+
+    def __init__(self, source: scoring.DatabaseSource, zf: zipfile.ZipFile):
+        self.source = source
+        self.zf = zf
+        self.binary_ids: set[int] = set()
+        self.binary_pairs: list[tuple[int, int]] = []
+
+    def call_graph(self, binary_id: int) -> nx.DiGraph:
+        cg = self.source.call_graph(binary_id)
+        if binary_id not in self.binary_ids:
+            _write_npz(self.zf, f"call-graphs/{binary_id}.npz", _call_graph_arrays(cg))
+            self.binary_ids.add(binary_id)
+        return cg
+
+    def similarity_graph(
+        self,
+        qb_id: int,
+        tb_id: int,
+        query_function_ids: list[int],
+        target_function_ids: list[int],
+    ) -> nx.Graph:
+        sg = self.source.similarity_graph(qb_id, tb_id, query_function_ids, target_function_ids)
+        _write_npz(
+            self.zf,
+            f"similarity/{qb_id}-{tb_id}.npz",
+            _similarity_arrays(sg, query_function_ids, target_function_ids),
+        )
+        self.binary_pairs.append((qb_id, tb_id))
+        return sg
+
+
+def export_bundle(
+    path: pl.Path,
+    names: list[str],
+    session: "m.Session",
+    firmup: bool = False,
+):
+    """Writes a bundle with everything that is needed to score the named datasets.
+    If firmup is set, the similarities of all functions of every binary pair are added.
+    These are much bigger than the similarities that neighbsim needs.
+    """
+    name2frame = {name: FunctionDataset.from_name(name).frame for name in names}
+    plan = scoring.plan_frames(name2frame)
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for index, name in enumerate(names):
+            buffer = io.BytesIO()
+            name2frame[name].to_pickle(buffer, compression=None)
+            zf.writestr(f"datasets/{index}.pickle", buffer.getvalue())
+
+        # Request exactly what execute_plan requests, so the bundle can answer all requests
+        source = _ExportingSource(scoring.DatabaseSource(session), zf)
+        groups = plan.rows.groupby(scoring.KEY_COLUMNS[:2], sort=True)
+        for (qb_id, tb_id), group in tqdm(groups, total=groups.ngroups):
+            scoring.neighbsim_args_for_rows(int(qb_id), int(tb_id), group, source)
+        binary_pairs = source.binary_pairs
+
+        firmup_binary_pairs = binary_pairs if firmup else []
+        for qb_id, tb_id in tqdm(firmup_binary_pairs):
+            sg = utils.similarity_graph_from_pair(qb_id, tb_id, session)
+            _write_npz(
+                zf,
+                f"firmup/{qb_id}-{tb_id}.npz",
+                _similarity_arrays(
+                    sg,
+                    _function_ids_with_vector(qb_id, session),
+                    _function_ids_with_vector(tb_id, session),
+                ),
+            )
+
+        manifest = BundleManifest(
+            version=BUNDLE_VERSION,
+            datasets=list(names),
+            binary_ids=sorted(source.binary_ids),
+            binary_pairs=binary_pairs,
+            firmup_binary_pairs=firmup_binary_pairs,
+        )
+        zf.writestr("manifest.json", msgspec.json.encode(manifest))
+
+
+class Bundle:
+    """Reads a bundle written by export_bundle.
+    Can be used as the source of scoring.execute_plan, just like scoring.DatabaseSource.
+    """
+
+    def __init__(self, path: pl.Path, call_graph_cache_size: int = 64):
+        self._zip = zipfile.ZipFile(path)
+        self.manifest = msgspec.json.decode(self._zip.read("manifest.json"), type=BundleManifest)
+        if self.manifest.version != BUNDLE_VERSION:
+            raise ValueError(
+                f"The bundle has version {self.manifest.version} but {BUNDLE_VERSION} is expected"
+            )
+        self.call_graph = functools.lru_cache(maxsize=call_graph_cache_size)(self._call_graph)
+
+    def close(self):
+        self._zip.close()
+
+    def __enter__(self) -> "Bundle":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def dataset(self, name: str) -> FunctionDataset:
+        """Returns the dataset like FunctionDataset.from_name."""
+        index = self.manifest.datasets.index(name)
+        frame = pd.read_pickle(io.BytesIO(self._zip.read(f"datasets/{index}.pickle")), compression=None)
+        return FunctionDataset(
+            name=name,
+            frame=frame,
+        )
+
+    def plan(self) -> scoring.ScoringPlan:
+        return scoring.plan_frames(
+            {name: self.dataset(name).frame for name in self.manifest.datasets}
+        )
+
+    def _call_graph(self, binary_id: int) -> nx.DiGraph:
+        with np.load(io.BytesIO(self._zip.read(f"call-graphs/{binary_id}.npz"))) as npz:
+            cg = nx.DiGraph()
+            for node, name, size in zip(
+                npz["nodes"].tolist(),
+                npz["names"].tolist(),
+                npz["sizes"].tolist(),
+            ):
+                cg.add_node(node, name=name, size=None if size < 0 else size)
+            cg.add_edges_from(zip(npz["sources"].tolist(), npz["destinations"].tolist()))
+
+        return cg
+
+    def similarity_graph(
+        self,
+        qb_id: int,
+        tb_id: int,
+        query_function_ids: list[int],
+        target_function_ids: list[int],
+    ) -> nx.Graph:
+        """Returns the same graph as utils.similarity_graph_from_function_ids."""
+        return _similarity_graph(
+            self._zip,
+            f"similarity/{qb_id}-{tb_id}.npz",
+            query_function_ids,
+            target_function_ids,
+        )
+
+    def firmup_args(self, qb_id: int, tb_id: int) -> FirmUPArgs:
+        """Returns the same args as firmup_args_from_binary_ids."""
+        if (qb_id, tb_id) not in self.manifest.firmup_binary_pairs:
+            raise KeyError(f"The bundle was exported without firmup similarities for ({qb_id}, {tb_id})")
+
+        return FirmUPArgs(
+            query_binary_id=qb_id,
+            target_binary_id=tb_id,
+            similarity_graph=_similarity_graph(self._zip, f"firmup/{qb_id}-{tb_id}.npz"),
+        )
+
+
+def score_neighbsim(
+    bundle: Bundle,
+    matching: MatchingOptions = MatchingOptions(),
+) -> dict[str, pd.DataFrame]:
+    """Scores all datasets of the bundle, see scoring.execute_plan."""
+    return scoring.execute_plan(bundle.plan(), bundle, matching=matching)
+
+
+def score_firmup(bundle: Bundle, max_steps: int | None = None) -> dict[str, pd.DataFrame]:
+    """Runs firmup for every query function of the datasets.
+    Returns a frame for every dataset with the columns query_binary_id, target_binary_id,
+    query_function_id, ptarget_function_id, match_function_id and steps.
+    A match_function_id of NA means that the game failed or the step limit was reached.
+    """
+    name2queries = {}
+    for name in bundle.manifest.datasets:
+        frame = bundle.dataset(name).frame
+        name2queries[name] = (
+            frame.loc[
+                frame["label"],
+                ["query_binary_id", "target_binary_id", "query_function_id", "target_function_id"],
+            ]
+            .rename(columns={"target_function_id": "ptarget_function_id"})
+            .drop_duplicates(subset=["query_binary_id", "target_binary_id", "query_function_id"])
+        )
+
+    queries = pd.concat(name2queries.values(), ignore_index=True)
+    matches = []
+    groups = queries.groupby(["query_binary_id", "target_binary_id"], sort=True)
+    for (qb_id, tb_id), group in tqdm(groups, total=groups.ngroups):
+        args = bundle.firmup_args(int(qb_id), int(tb_id))
+        query_function_ids = group["query_function_id"].unique().tolist()
+        for qf_id, batch_result in firmup_batch(query_function_ids, args, max_steps=max_steps).items():
+            result = batch_result.result
+            matches.append(
+                {
+                    "query_binary_id": qb_id,
+                    "target_binary_id": tb_id,
+                    "query_function_id": qf_id,
+                    "match_function_id": None if result is None else next(iter(result.matching[qf_id])),
+                    "steps": None if result is None else result.steps,
+                }
+            )
+
+    matches = pd.DataFrame(
+        matches,
+        columns=["query_binary_id", "target_binary_id", "query_function_id", "match_function_id", "steps"],
+    ).astype({"match_function_id": pd.Int64Dtype(), "steps": pd.Int64Dtype()})
+
+    return {
+        name: frame.merge(
+            matches,
+            on=["query_binary_id", "target_binary_id", "query_function_id"],
+            how="left",
+        )
+        for name, frame in name2queries.items()
+    }
+
+
+def _write_npz(zf: zipfile.ZipFile, name: str, arrays: dict[str, np.ndarray]):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    zf.writestr(name, buffer.getvalue())
+
+
+def _call_graph_arrays(cg: nx.DiGraph) -> dict[str, np.ndarray]:
+    nodes = list(cg.nodes)
+    edges = list(cg.edges)
+    return {
+        "nodes": np.array(nodes, dtype=np.int64),
+        "names": np.array([cg.nodes[node].get("name") or "" for node in nodes], dtype=np.str_),
+        # Sizes that are not known are stored as -1
+        "sizes": np.array(
+            [-1 if cg.nodes[node].get("size") is None else cg.nodes[node]["size"] for node in nodes],
+            dtype=np.int64,
+        ),
+        "sources": np.array([src for src, _ in edges], dtype=np.int64),
+        "destinations": np.array([dst for _, dst in edges], dtype=np.int64),
+    }
+
+
+def _similarity_arrays(
+    sg: nx.Graph,
+    query_function_ids: list[int],
+    target_function_ids: list[int],
+) -> dict[str, np.ndarray]:
+    """Stores the similarity graph as a dense matrix.
+    Pairs without an edge (e.g. if a function is not in e."function:all") are NaN.
+    """
+    rows, cols, weights = utils.similarity_graph_entries(
+        sg,
+        query_function_ids,
+        target_function_ids,
+    )
+    similarity = np.full((len(query_function_ids), len(target_function_ids)), np.nan)
+    similarity[rows, cols] = weights
+
+    return {
+        "query_function_ids": np.array(query_function_ids, dtype=np.int64),
+        "target_function_ids": np.array(target_function_ids, dtype=np.int64),
+        "similarity": similarity,
+    }
+
+
+def _similarity_graph(
+    zf: zipfile.ZipFile,
+    name: str,
+    query_function_ids: list[int] | None = None,
+    target_function_ids: list[int] | None = None,
+) -> nx.Graph:
+    """Reads the similarity graph of the given functions (or all functions if None)."""
+    with np.load(io.BytesIO(zf.read(name))) as npz:
+        stored_query_function_ids = npz["query_function_ids"]
+        stored_target_function_ids = npz["target_function_ids"]
+        similarity = npz["similarity"]
+
+    rows = _positions(stored_query_function_ids, query_function_ids)
+    cols = _positions(stored_target_function_ids, target_function_ids)
+    similarity = similarity[np.ix_(rows, cols)]
+
+    qids = stored_query_function_ids[rows]
+    tids = stored_target_function_ids[cols]
+    row_idx, col_idx = np.nonzero(~np.isnan(similarity))
+
+    sg = nx.Graph()
+    sg.add_weighted_edges_from(
+        zip(
+            qids[row_idx].tolist(),
+            tids[col_idx].tolist(),
+            similarity[row_idx, col_idx].tolist(),
+        )
+    )
+    return sg
+
+
+def _positions(stored_ids: np.ndarray, ids: list[int] | None) -> np.ndarray:
+    if ids is None:
+        return np.arange(len(stored_ids))
+
+    id2position = {id: position for position, id in enumerate(stored_ids.tolist())}
+    missing = [id for id in ids if id not in id2position]
+    if len(missing) != 0:
+        raise KeyError(f"The bundle has no similarities for the functions {missing}")
+
+    return np.array([id2position[id] for id in ids], dtype=np.int64)
+
+
+def _function_ids_with_vector(binary_id: int, session: "m.Session") -> list[int]:
+    stmt = sa.text(
+        """
+        SELECT f.id
+        FROM e."function:all" f
+        WHERE f.binary_id = :binary_id AND f.vector IS NOT NULL
+        ORDER BY f.id
+        """
+    )
+    return list(session.scalars(stmt, {"binary_id": binary_id}))
@@ -1,8 +1,13 @@
+import collections
 import pathlib as pl
 
 import msgspec
+import numpy as np
 import pandas as pd
 
+#: The bins that the size-like factors (e.g. qsize) are divided into.
+BINS = ["low", "medium", "high"]
+
 
 class DatasetOptions(msgspec.Struct):
     size: str | None = None
@@ -83,14 +88,169 @@ class FunctionDataset(msgspec.Struct):
 
         if keep is not None:
             for column in keep:
-                if keep in columns:
+                if column in columns:
                     continue
                 columns.append(column)
 
         return FunctionDataset(
             name=self.name,
-            frame=self.frame[columns].copy(),
+            frame=_select_columns(self.frame, columns),
+        )
+
+
+def _select_columns(frame: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """Like frame[columns] but shares the column data with frame instead of copying it."""
+    return pd.DataFrame(
+        {column: frame[column] for column in columns},
+        copy=False,
+    )
+
+
+def compact_frame(frame: pd.DataFrame) -> pd.DataFrame:
+    """Downcasts ids to int32, floats to float32 and bins to categoricals.
+    Takes roughly half the memory of the frames that FunctionDataset.from_name returns.
+    """
+    columns = {}
+    for column, series in frame.items():
+        compact = series
+        if column.endswith("_id") and pd.api.types.is_integer_dtype(series):
+            info = np.iinfo(np.int32)
+            if len(series) == 0 or (series.min() >= info.min and series.max() <= info.max):
+                compact = series.astype(np.int32)
+        elif pd.api.types.is_float_dtype(series):
+            compact = series.astype(np.float32)
+        elif series.dtype == object and series.isin(BINS).all():
+            compact = pd.Categorical(series, categories=BINS, ordered=True)
+        columns[column] = compact
+
+    return pd.DataFrame(columns, index=frame.index, copy=False)
+
+
+class DatasetRegistry:
+    """Loads datasets on first access and keeps them within a memory budget.
+    When the budget is exceeded, the least recently used datasets are evicted.
+
+    Columns from the dataset's pickle (e.g. 'caller_matching') are only loaded
+    when they are requested for the first time. 'neighbsim' is loaded by default.
+    Frames are compacted (see compact_frame).
+
+    Note that the memory usage of columns that contain python objects (e.g. graphs)
+    is underestimated.
+    """
+
+    def __init__(self, memory_budget: int = 8 * 2**30):
+        #: The memory budget in bytes
+        self.memory_budget = memory_budget
+        self._name2dataset: collections.OrderedDict[str, FunctionDataset] = (
+            collections.OrderedDict()
         )
+        #: The memory usage of every loaded dataset, measured when it was loaded or extended
+        self._name2usage: dict[str, int] = {}
+        self._usage = 0
+
+    def get(self, name: str, columns: list[str] | None = None) -> FunctionDataset:
+        """Returns the dataset with all csv columns and the given pickle columns."""
+        if columns is None:
+            columns = ["neighbsim"]
+
+        # The registry is only changed after loading succeeded,
+        # so a failed load (e.g. of an unknown column) leaves it consistent
+        dataset = self._name2dataset.get(name)
+        changed = dataset is None
+        if dataset is None:
+            dataset = FunctionDataset.from_name(name)
+            dataset = FunctionDataset(
+                name=name,
+                frame=compact_frame(dataset.frame),
+            )
+
+        missing = [column for column in columns if column not in dataset.frame]
+        if len(missing) != 0:
+            dataset = FunctionDataset(
+                name=name,
+                frame=pd.concat(
+                    [dataset.frame, load_pickle_columns(name, missing)],
+                    axis=1,
+                ),
+            )
+            changed = True
+
+        self._name2dataset[name] = dataset
+        self._name2dataset.move_to_end(name)
+        if changed:
+            usage = _memory_usage(dataset)
+            self._usage += usage - self._name2usage.get(name, 0)
+            self._name2usage[name] = usage
+            self._evict()
+
+        return dataset
+
+    def __getitem__(self, name: str) -> FunctionDataset:
+        return self.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._name2dataset
+
+    def evict(self, name: str):
+        self._name2dataset.pop(name, None)
+        self._usage -= self._name2usage.pop(name, 0)
+
+    def memory_usage(self) -> int:
+        """Returns the (estimated) memory usage of all loaded datasets in bytes."""
+        return self._usage
+
+    def _evict(self):
+        # Never evict the most recently used dataset
+        while self._usage > self.memory_budget and len(self._name2dataset) > 1:
+            name, _ = self._name2dataset.popitem(last=False)
+            self._usage -= self._name2usage.pop(name)
+
+
+def _memory_usage(dataset: FunctionDataset) -> int:
+    return int(dataset.frame.memory_usage(deep=True).sum())
+
+
+def load_pickle_columns(name: str, columns: list[str]) -> pd.DataFrame:
+    """Loads some columns of the dataset's pickle.
+
+    The first call unpickles the whole pickle once and stores every column in its own
+    file in datasets/{name}.columns/, so later calls only read the requested columns.
+    The column files are written again when the pickle is newer.
+    """
+    pickle_path = pl.Path("datasets", f"{name}.pickle.gz")
+    if not pickle_path.exists():
+        raise ValueError(f"The dataset {name} was expected at {pickle_path} but not found.")
+
+    columns_dir = pl.Path("datasets", f"{name}.columns")
+    index_path = columns_dir / "index.pickle"
+    if not index_path.exists() or index_path.stat().st_mtime < pickle_path.stat().st_mtime:
+        _split_pickle(pickle_path, columns_dir)
+
+    missing = [column for column in columns if not (columns_dir / f"{column}.pickle").exists()]
+    if len(missing) != 0:
+        raise KeyError(f"The dataset {name} has no columns {missing}")
+
+    index = pd.read_pickle(index_path)
+    frame = pd.DataFrame(
+        {
+            column: pd.read_pickle(columns_dir / f"{column}.pickle").set_axis(index)
+            for column in columns
+        },
+        index=index,
+    )
+    if "neighbsim" in frame:
+        frame = frame.astype({"neighbsim": np.float32})
+
+    return frame
+
+
+def _split_pickle(pickle_path: pl.Path, columns_dir: pl.Path):
+    columns_dir.mkdir(parents=True, exist_ok=True)
+    pickle_frame = pd.read_pickle(pickle_path)
+    for column, series in pickle_frame.items():
+        series.reset_index(drop=True).to_pickle(columns_dir / f"{column}.pickle")
+    # The index is written last, as its mtime marks the column files as complete
+    pd.to_pickle(pickle_frame.index, columns_dir / "index.pickle")
 
 
 def _massage_frame(frame: pd.DataFrame) -> pd.DataFrame:
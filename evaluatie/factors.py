@@ -0,0 +1,241 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""The factors that datasets are stratified by (e.g. qsize and qneighborhood_size).
+
+The factors of all functions of many binaries are fetched with two statements and
+computed in one vectorized pass. They are cached per function_id in datasets/factors.npz,
+so joining them onto a FunctionDataset needs no queries.
+"""
+
+import logging
+import pathlib as pl
+import typing
+
+import msgspec
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from evaluatie.data import BINS, FunctionDataset
+
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
+#: The factors of a function.
+#: byte_size is the size in bytes, size the number of basic blocks,
+#: complexity the cyclomatic complexity of the control-flow graph and
+#: neighborhood_size the number of callers plus the number of callees.
+#: The latter are counted like in e."factors:raw" (see the README),
+#: i.e. every edge of e.call_graph_edge is counted, including repeated edges and self-loops.
+FACTOR_COLUMNS = [
+    "byte_size",
+    "size",
+    "complexity",
+    "neighborhood_size",
+]
+
+DEFAULT_CACHE_PATH = pl.Path("datasets", "factors.npz")
+
+
+class FactorOptions(msgspec.Struct, frozen=True):
+    """How the factors are divided into BINS."""
+
+    #: The quantiles that separate the bins. A value that is equal to a quantile
+    #: is in the lower bin.
+    quantiles: tuple[float, ...] = (1 / 3, 2 / 3)
+
+    def __post_init__(self):
+        if len(self.quantiles) != len(BINS) - 1:
+            raise ValueError(f"Expected {len(BINS) - 1} quantiles, got {len(self.quantiles)}")
+        if list(self.quantiles) != sorted(self.quantiles):
+            raise ValueError("The quantiles must be sorted")
+
+
+class FactorTable(msgspec.Struct):
+    """The raw factors of all functions of some binaries.
+    The frame is indexed by function_id and has the columns binary_id and FACTOR_COLUMNS.
+    """
+
+    frame: pd.DataFrame
+
+    @classmethod
+    def from_binary_ids(cls, binary_ids: list[int], session: "m.Session") -> "FactorTable":
+        functions, edges = _fetch(binary_ids, session)
+        return cls(frame=compute_factors(functions, edges))
+
+    @classmethod
+    def from_cache(
+        cls,
+        binary_ids: list[int],
+        session: "m.Session",
+        path: pl.Path = DEFAULT_CACHE_PATH,
+    ) -> "FactorTable":
+        """Loads the cached factors and fetches the factors of binaries that are not cached.
+        Only the factors of the given binaries are returned, even if the cache has more.
+        """
+        table = cls.load(path) if path.exists() else cls.empty()
+        missing = sorted(set(binary_ids) - set(table.binary_ids))
+        if len(missing) != 0:
+            table = table.concat(cls.from_binary_ids(missing, session))
+            table.save(path)
+
+        return table.for_binaries(binary_ids)
+
+    @classmethod
+    def empty(cls) -> "FactorTable":
+        return cls(
+            frame=pd.DataFrame(
+                {column: pd.Series(dtype=np.int64) for column in ["binary_id", *FACTOR_COLUMNS]},
+                index=pd.Index([], dtype=np.int64, name="function_id"),
+            )
+        )
+
+    @classmethod
+    def load(cls, path: pl.Path = DEFAULT_CACHE_PATH) -> "FactorTable":
+        with np.load(path) as npz:
+            return cls(
+                frame=pd.DataFrame(
+                    {column: npz[column] for column in ["binary_id", *FACTOR_COLUMNS]},
+                    index=pd.Index(npz["function_id"], name="function_id"),
+                )
+            )
+
+    def save(self, path: pl.Path = DEFAULT_CACHE_PATH):
+        np.savez(
+            path,
+            function_id=self.frame.index.to_numpy(),
+            **{column: self.frame[column].to_numpy() for column in ["binary_id", *FACTOR_COLUMNS]},
+        )
+
+    @property
+    def binary_ids(self) -> list[int]:
+        return self.frame["binary_id"].unique().tolist()
+
+    def for_binaries(self, binary_ids: list[int]) -> "FactorTable":
+        return FactorTable(frame=self.frame[self.frame["binary_id"].isin(binary_ids)])
+
+    def for_functions(self, function_ids: list[int]) -> "FactorTable":
+        return FactorTable(frame=self.frame[self.frame.index.isin(function_ids)])
+
+    def concat(self, other: "FactorTable") -> "FactorTable":
+        frame = pd.concat([self.frame, other.frame])
+        return FactorTable(frame=frame[~frame.index.duplicated(keep="last")])
+
+    def binned(self, options: FactorOptions = FactorOptions()) -> pd.DataFrame:
+        """Returns the factors divided into BINS.
+        The quantiles are computed over all functions of the table,
+        see for_binaries and for_functions to restrict it.
+        """
+        return pd.DataFrame(
+            {column: bin_factor(self.frame[column], options) for column in FACTOR_COLUMNS},
+            index=self.frame.index,
+        )
+
+
+def compute_factors(functions: pd.DataFrame, edges: pd.DataFrame) -> pd.DataFrame:
+    """Computes the factors of all functions.
+    functions has the columns function_id, binary_id, byte_size, cfg_node_count and
+    cfg_edge_count, edges the call-graph edges as src_id and dst_id.
+    The neighborhood_size is the amount of edges that start at the function plus the
+    amount of edges that end at it, like in e."factors:raw".
+    """
+    functions = functions.drop_duplicates(subset="function_id").set_index("function_id")
+    function_ids = functions.index
+
+    # Every edge counts as a callee of src_id and as a caller of dst_id
+    endpoints = np.concatenate([edges["src_id"].to_numpy(), edges["dst_id"].to_numpy()])
+    neighbor_ids, neighbor_counts = np.unique(endpoints.astype(np.int64), return_counts=True)
+
+    return pd.DataFrame(
+        {
+            "binary_id": functions["binary_id"].to_numpy(dtype=np.int64),
+            "byte_size": functions["byte_size"].to_numpy(dtype=np.int64),
+            "size": functions["cfg_node_count"].to_numpy(dtype=np.int64),
+            "complexity": (
+                functions["cfg_edge_count"] - functions["cfg_node_count"] + 2
+            ).to_numpy(dtype=np.int64),
+            "neighborhood_size": pd.Series(neighbor_counts, index=neighbor_ids)
+            .reindex(function_ids, fill_value=0)
+            .to_numpy(dtype=np.int64),
+        },
+        index=function_ids,
+    )
+
+
+def bin_factor(values: pd.Series, options: FactorOptions = FactorOptions()) -> pd.Categorical:
+    thresholds = np.quantile(values.to_numpy(), options.quantiles) if len(values) != 0 else []
+    codes = np.searchsorted(thresholds, values.to_numpy(), side="left")
+    return pd.Categorical.from_codes(codes, categories=BINS, ordered=True)
+
+
+def join_factors(
+    dataset: FunctionDataset,
+    table: FactorTable,
+    options: FactorOptions = FactorOptions(),
+) -> FunctionDataset:
+    """Adds the binned factors of the query and target functions as q* and t* columns
+    (e.g. qsize and tneighborhood_size), replacing the columns from the csv.
+    The quantiles are computed over the functions of the dataset, so the bins do not
+    depend on which other binaries are in the table.
+    Functions that are not in the table get no bin.
+    """
+    function_ids = pd.unique(
+        np.concatenate(
+            [
+                dataset.frame["query_function_id"].to_numpy(),
+                dataset.frame["target_function_id"].to_numpy(),
+            ]
+        )
+    )
+    binned = table.for_functions(function_ids).binned(options)
+    frame = dataset.frame.copy(deep=False)
+    for prefix, id_column in [("q", "query_function_id"), ("t", "target_function_id")]:
+        positions = binned.index.get_indexer(frame[id_column].to_numpy())
+        missing = positions == -1
+        if missing.any():
+            logging.warning(
+                f"{dataset.name}: {missing.sum()} rows have a {id_column} without factors"
+            )
+        for column in FACTOR_COLUMNS:
+            # The appended -1 (no bin) is what missing functions (position -1) index
+            codes = np.append(binned[column].cat.codes.to_numpy(), -1)[positions]
+            frame[f"{prefix}{column}"] = pd.Categorical.from_codes(
+                codes, categories=BINS, ordered=True
+            )
+
+    return FunctionDataset(name=dataset.name, frame=frame)
+
+
+def _fetch(binary_ids: list[int], session: "m.Session") -> tuple[pd.DataFrame, pd.DataFrame]:
+    functions_stmt = sa.text(
+        """
+        SELECT f.id, f.binary_id, f.size, ft.cfg_node_count, ft.cfg_edge_count
+        FROM e.function f
+            JOIN features ft ON (
+                ft.id = f.features_id
+            )
+        WHERE f.binary_id = ANY(:binary_ids)
+        """
+    )
+    edges_stmt = sa.text(
+        """
+        SELECT src_id, dst_id
+        FROM e.call_graph_edge cg
+        WHERE cg.src_binary_id = ANY(:binary_ids) OR cg.dst_binary_id = ANY(:binary_ids)
+        """
+    )
+    params = {"binary_ids": list(binary_ids)}
+
+    functions = pd.DataFrame(
+        session.execute(functions_stmt, params).all(),
+        columns=["function_id", "binary_id", "byte_size", "cfg_node_count", "cfg_edge_count"],
+    )
+    edges = pd.DataFrame(
+        session.execute(edges_stmt, params).all(),
+        columns=["src_id", "dst_id"],
+    )
+
+    return functions, edges
@@ -1,8 +1,26 @@
-from .firmup import FirmUPArgs, FirmUPResult, firmup, firmup_args_from_binary_ids
+from .firmup import (
+    FirmUPArgs,
+    FirmUPBatchResult,
+    FirmUPMemo,
+    FirmUPResult,
+    firmup,
+    firmup_args_from_binary_ids,
+    firmup_batch,
+    play_firmup,
+)
+from .image import FirmUPImageOptions, FirmUPImageResult, FirmUPTargetOutcome, firmup_image
 
 __all__ = [
     "firmup",
     "FirmUPArgs",
     "FirmUPResult",
-    "firmup_args_from_binary_ids"
+    "firmup_args_from_binary_ids",
+    "firmup_batch",
+    "FirmUPBatchResult",
+    "FirmUPMemo",
+    "play_firmup",
+    "firmup_image",
+    "FirmUPImageOptions",
+    "FirmUPImageResult",
+    "FirmUPTargetOutcome",
 ]
\ No newline at end of file
@@ -1,10 +1,15 @@
+import functools
+import time
+import typing
 
 import msgspec
 import networkx as nx
 
-from evaluatie import models as m
 from evaluatie import utils
 
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
 
 class FirmUPArgs(msgspec.Struct):
     similarity_graph: nx.Graph
@@ -20,13 +25,140 @@ class StepLimitReachedError(Exception):
     pass
 
 
+class DeadlineReachedError(Exception):
+    """Raised by play_firmup if the deadline passed before the game ended."""
+
+    def __init__(self, steps: int):
+        super().__init__(f"The deadline passed after {steps} steps")
+        #: The steps that were played until the deadline
+        self.steps = steps
+
+
+class FirmUPMemo:
+    """Game state that is shared by all queries of one binary pair (see firmup_batch).
+
+    Instead of restricting the similarity graph to all unmatched functions in every step,
+    every function's candidates are sorted by similarity once.
+    The best match is then the first unmatched candidate.
+    Ties are broken in the same order as in firmup.
+    """
+
+    def __init__(self, args: FirmUPArgs):
+        self.args = args
+        self._preferences: dict[int, list[int]] = {}
+        #: Functions that are each others best match in the whole similarity graph.
+        #: A game for such a function always ends after the first step.
+        self.settled: dict[int, int] = {}
+        #: Maps (query_function_id, max_steps) to the result, whether the step limit was reached
+        #: and the steps that the game took
+        self.results: dict[tuple[int, int | None], tuple[FirmUPResult | None, bool, int]] = {}
+
+    def best_match(self, function_id: int, matching: nx.Graph) -> int | None:
+        preferences = self._preferences.get(function_id)
+        if preferences is None:
+            sg = self.args.similarity_graph
+            # Sorting is stable, so candidates with equal similarity stay in adjacency order,
+            # which is the order that max() in _get_best_match breaks ties in.
+            preferences = sorted(
+                sg[function_id],
+                key=lambda other_id: sg.get_edge_data(function_id, other_id)["weight"],
+                reverse=True,
+            )
+            self._preferences[function_id] = preferences
+
+        for other_id in preferences:
+            if other_id not in matching:
+                return other_id
+
+        return None
+
+    def settle(self, left_id: int, right_id: int):
+        self.settled[left_id] = right_id
+        self.settled[right_id] = left_id
+
+
+class FirmUPBatchResult(msgspec.Struct):
+    #: None if the game failed or the step limit was reached
+    result: FirmUPResult | None
+    step_limit_reached: bool
+    #: Steps that were not played, because the result was known from earlier queries
+    steps_saved: int
+
+
+def firmup_batch(
+    query_function_ids: list[int],
+    args: FirmUPArgs,
+    max_steps: int | None = None,
+    memo: FirmUPMemo | None = None,
+) -> dict[int, FirmUPBatchResult]:
+    """Runs firmup for many queries of the same binary pair.
+    The results are the same as running firmup for every query independently.
+    Pass the same memo to several calls to share the game state between them.
+    """
+    if memo is None:
+        memo = FirmUPMemo(args)
+    if memo.args is not args:
+        raise ValueError("The memo was created for different args")
+
+    ret = {}
+    for query_function_id in query_function_ids:
+        key = (query_function_id, max_steps)
+        if key in memo.results:
+            result, step_limit_reached, steps = memo.results[key]
+            ret[query_function_id] = FirmUPBatchResult(
+                result=result,
+                step_limit_reached=step_limit_reached,
+                steps_saved=steps,
+            )
+            continue
+
+        steps_saved = 0
+        if query_function_id in memo.settled and (max_steps is None or max_steps > 1):
+            matching = nx.Graph()
+            matching.add_edge(query_function_id, memo.settled[query_function_id])
+            result, steps = FirmUPResult(matching=matching, steps=1), 1
+            steps_saved = 1
+        else:
+            result, steps = play_firmup(query_function_id, args, max_steps, memo=memo)
+
+        step_limit_reached = _step_limit_reached(steps, max_steps)
+        if step_limit_reached:
+            result = None
+
+        memo.results[key] = (result, step_limit_reached, steps)
+        ret[query_function_id] = FirmUPBatchResult(
+            result=result,
+            step_limit_reached=step_limit_reached,
+            steps_saved=steps_saved,
+        )
+
+    return ret
+
+
 def firmup(query_function_id: int, args: FirmUPArgs, max_steps: int|None = None) -> FirmUPResult|None:
     """Returns None if the firmup algorithm failed.
     If it succeds, it returns the matching.
     Raises StepLimitReachedError if the maximum number of steps would be exceeded"""
-    # This implements the algorithm exactly as described in the paper
+    result, steps = play_firmup(query_function_id, args, max_steps)
+    if _step_limit_reached(steps, max_steps):
+        raise StepLimitReachedError
 
-    sg = args.similarity_graph
+    return result
+
+
+def play_firmup(
+    query_function_id: int,
+    args: FirmUPArgs,
+    max_steps: int | None = None,
+    memo: FirmUPMemo | None = None,
+    deadline: float | None = None,
+) -> tuple[FirmUPResult | None, int]:
+    """Plays the game for at most max_steps steps.
+    Unlike firmup, this does not raise when max_steps is reached.
+    Returns the result (None if the query was not matched) and the steps that were played.
+    Raises DeadlineReachedError if time.monotonic() reaches deadline before the game ended.
+    """
+    # This implements the algorithm exactly as described in the paper
 
     # "Matches" in the paper
     matching = nx.Graph()
@@ -44,6 +176,8 @@ def firmup(query_function_id: int, args: FirmUPArgs, max_steps: int|None = None)
     failed = False
     # "A match was found for qv"
     while (query_function_id not in matching) and not failed and n_steps < max_steps:
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineReachedError(n_steps)
         n_steps += 1
         modified = False
         # Impelemnts lines 4 to 8.
@@ -54,17 +188,11 @@ def firmup(query_function_id: int, args: FirmUPArgs, max_steps: int|None = None)
         other_binary_id = args.query_binary_id if my_binary_id == args.target_binary_id else args.target_binary_id
 
         # "we search for the best match for M in Other, while ignoring all previously matched procedures."
-        unmatched_sg = sg.subgraph(
-            # Restrict to all unmatched nodes
-            [node for node in sg.nodes if node not in matching]
-        )
+        best_match = _best_match_function(args.similarity_graph, matching, memo)
 
         # Line 9.
         # Corresponds to "Forward".
-        forward_match = _get_best_match(
-            my_function_id,
-            similarity_graph=unmatched_sg,
-        )
+        forward_match = best_match(my_function_id)
         # Not mentioned in the paper.
         # Still, if all functions other_binary_id are already part of the matching,
         # there is no forwared_match as all functions are already matched.
@@ -75,10 +203,7 @@ def firmup(query_function_id: int, args: FirmUPArgs, max_steps: int|None = None)
         
         # Line 10.
         # Corresponds to "Back".
-        backward_match = _get_best_match(
-            forward_match,
-            similarity_graph=unmatched_sg,
-        )
+        backward_match = best_match(forward_match)
         # Same check as for the forward match
         if backward_match is None:
             failed = True
@@ -90,7 +215,7 @@ def firmup(query_function_id: int, args: FirmUPArgs, max_steps: int|None = None)
         # Line 11.
         # "Back is M, meaning that M ∼ Forward"
         if my_function_id == backward_match:
-            matching.add_edge(my_function_id, forward_match)
+            _add_match(matching, my_function_id, forward_match, memo)
 
             top = unmatched_stack.pop(-1)
             assert top == my_stack_entry
@@ -121,16 +246,37 @@ def firmup(query_function_id: int, args: FirmUPArgs, max_steps: int|None = None)
         # Thus I added an additional check above.
         failed = not modified
 
-    if n_steps >= max_steps:
-        raise StepLimitReachedError
-
     if query_function_id not in matching:
-        return None
+        return None, n_steps
 
-    return FirmUPResult(
-        steps=n_steps,
-        matching=matching,
+    return FirmUPResult(steps=n_steps, matching=matching), n_steps
+
+
+def _step_limit_reached(steps: int, max_steps: int | None) -> bool:
+    # A game that ends in its last step is reported as reaching the limit, too
+    return max_steps is not None and steps >= max_steps
+
+
+def _best_match_function(
+    similarity_graph: nx.Graph,
+    matching: nx.Graph,
+    memo: FirmUPMemo | None,
+) -> typing.Callable[[int], int | None]:
+    if memo is not None:
+        return functools.partial(memo.best_match, matching=matching)
+
+    unmatched_sg = similarity_graph.subgraph(
+        # Restrict to all unmatched nodes
+        [node for node in similarity_graph.nodes if node not in matching]
     )
+    return functools.partial(_get_best_match, similarity_graph=unmatched_sg)
+
+
+def _add_match(matching: nx.Graph, left_id: int, right_id: int, memo: FirmUPMemo | None):
+    # Without previous matches, both are the best match of each other in the whole graph
+    if memo is not None and len(matching) == 0:
+        memo.settle(left_id, right_id)
+    matching.add_edge(left_id, right_id)
 
 
 def _get_best_match(function_id: int, similarity_graph: nx.Graph):
@@ -142,13 +288,23 @@ def _get_best_match(function_id: int, similarity_graph: nx.Graph):
         key=lambda other_id: similarity_graph.get_edge_data(function_id, other_id)["weight"],
     )
 
-def firmup_args_from_binary_ids(query_binary_id: int, target_binary_id: int) -> FirmUPArgs:
-    with m.Session() as session:
-        similarity_graph = utils.similarity_graph_from_pair(
-            qb_id=query_binary_id,
-            tb_id=target_binary_id,
-            session=session,
-        )
+def firmup_args_from_binary_ids(
+    query_binary_id: int,
+    target_binary_id: int,
+    session: "m.Session | None" = None,
+) -> FirmUPArgs:
+    """Opens its own session if no session is given."""
+    if session is None:
+        from evaluatie import models as m
+
+        with m.Session() as session:
+            return firmup_args_from_binary_ids(query_binary_id, target_binary_id, session)
+
+    similarity_graph = utils.similarity_graph_from_pair(
+        qb_id=query_binary_id,
+        tb_id=target_binary_id,
+        session=session,
+    )
 
     return FirmUPArgs(
         query_binary_id=query_binary_id,
@@ -0,0 +1,250 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""Locates a query function in all executables of a firmware image with firmup."""
+
+import concurrent.futures
+import math
+import multiprocessing
+import time
+import typing
+
+import msgspec
+import networkx as nx
+
+from evaluatie import utils
+from evaluatie.firmup.firmup import DeadlineReachedError, FirmUPArgs, play_firmup
+
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
+#: The outcomes of a game against a target binary.
+#: "matched": The query was matched within max_steps. "failed": The game ended without a match.
+#: "step_limit": The game reached max_steps without a match.
+#: "budget": The global step or time budget was exhausted before the game ended.
+OUTCOMES = ["matched", "failed", "step_limit", "budget"]
+
+#: The state of a worker process, see _init_worker.
+#: "steps" is an array of the steps that all games used, the steps that running rounds
+#: reserved and the amount of games that wait for a round, shared by all worker processes.
+_worker_state: dict[str, typing.Any] = {}
+
+
+class FirmUPImageOptions(msgspec.Struct, frozen=True):
+    #: The step limit of every game
+    max_steps: int | None = None
+    #: The steps that all games together may take
+    step_budget: int | None = None
+    #: In seconds
+    time_budget: float | None = None
+    max_workers: int | None = None
+    #: The step limit of the first round of every game, see firmup_image
+    initial_steps: int = 64
+
+
+class FirmUPTargetOutcome(msgspec.Struct, frozen=True):
+    target_binary_id: int
+    #: One of OUTCOMES
+    outcome: str
+    match_function_id: int | None = None
+    #: The steps of the game's last round. None if the game was not played to its end.
+    steps: int | None = None
+
+
+class FirmUPImageResult(msgspec.Struct, frozen=True):
+    #: Maps every target binary id to its outcome
+    outcomes: dict[int, FirmUPTargetOutcome]
+    #: The steps that all games took, including rounds that were played again
+    steps: int
+    #: In seconds
+    elapsed: float
+
+
+def firmup_image(
+    query_function_id: int,
+    query_binary_id: int,
+    target_binary_ids: list[int],
+    session: "m.Session",
+    options: FirmUPImageOptions = FirmUPImageOptions(),
+) -> FirmUPImageResult:
+    """Plays firmup for the query against every target binary in a process pool.
+    The similarities of all target binaries are fetched with a single statement,
+    see utils.similarity_graphs_from_query_binary.
+
+    Every game is a single task, so each similarity graph is sent to a worker once.
+    The worker plays the game in rounds with a step limit that doubles every round
+    (up to max_steps). This way, the budget is spent on short games first:
+    Before every round, the worker reserves the round's steps from the shared step_budget
+    and checks the time_budget. Unused steps are returned after the round.
+    If the budget does not allow a longer round, the game is given up with outcome "budget".
+    When time_budget is over, games that were not started are cancelled and running games
+    stop within a step.
+
+    Games are deterministic, so the outcomes are the same as firmup with max_steps,
+    except that a match in the last allowed step is reported as "matched".
+    """
+    tb_id2graph = utils.similarity_graphs_from_query_binary(
+        query_binary_id,
+        target_binary_ids,
+        session,
+    )
+    return firmup_image_from_graphs(query_function_id, query_binary_id, tb_id2graph, options)
+
+
+def firmup_image_from_graphs(
+    query_function_id: int,
+    query_binary_id: int,
+    tb_id2graph: dict[int, nx.Graph],
+    options: FirmUPImageOptions = FirmUPImageOptions(),
+) -> FirmUPImageResult:
+    """See firmup_image."""
+    start = time.monotonic()
+    # time.monotonic is system-wide on linux, so the workers can compare against it
+    deadline = start + options.time_budget if options.time_budget is not None else None
+
+    outcomes = {}
+    targets = []
+    for tb_id, similarity_graph in tb_id2graph.items():
+        # Without a vector the query has no similarities and every game fails immediately
+        if query_function_id not in similarity_graph:
+            outcomes[tb_id] = FirmUPTargetOutcome(target_binary_id=tb_id, outcome="failed")
+            continue
+        targets.append(tb_id)
+
+    ctx = multiprocessing.get_context()
+    steps = ctx.Array("q", [0, 0, len(targets)])
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=options.max_workers,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(steps,),
+    )
+    try:
+        future2tb_id = {
+            executor.submit(
+                _play_target,
+                query_function_id,
+                FirmUPArgs(
+                    similarity_graph=tb_id2graph[tb_id],
+                    query_binary_id=query_binary_id,
+                    target_binary_id=tb_id,
+                ),
+                options,
+                deadline,
+            ): tb_id
+            for tb_id in targets
+        }
+        timeout = max(deadline - time.monotonic(), 0) if deadline is not None else None
+        done, _ = concurrent.futures.wait(future2tb_id, timeout=timeout)
+        for future in done:
+            tb_id = future2tb_id[future]
+            outcome, match_function_id, game_steps = future.result()
+            outcomes[tb_id] = FirmUPTargetOutcome(
+                target_binary_id=tb_id,
+                outcome=outcome,
+                match_function_id=match_function_id,
+                steps=game_steps,
+            )
+    finally:
+        # Running games stop within a step after the deadline, see _play_target.
+        # Waiting for them keeps their steps in the result
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    for tb_id in targets:
+        if tb_id not in outcomes:
+            outcomes[tb_id] = FirmUPTargetOutcome(target_binary_id=tb_id, outcome="budget")
+
+    with steps.get_lock():
+        used = steps[0]
+
+    return FirmUPImageResult(
+        outcomes={tb_id: outcomes[tb_id] for tb_id in tb_id2graph},
+        steps=used,
+        elapsed=time.monotonic() - start,
+    )
+
+
+def _init_worker(steps: "multiprocessing.sharedctypes.SynchronizedArray"):
+    _worker_state["steps"] = steps
+
+
+def _play_target(
+    query_function_id: int,
+    args: FirmUPArgs,
+    options: FirmUPImageOptions,
+    deadline: float | None,
+) -> tuple[str, int | None, int | None]:
+    """Plays the game in rounds with a doubling step limit.
+    Returns the outcome, the matched function and the steps of the last round.
+    """
+    limit = 0
+    while True:
+        next_limit = _reserve(limit, options, deadline)
+        if next_limit is None:
+            return "budget", None, None
+        limit = next_limit
+
+        try:
+            result, game_steps = play_firmup(
+                query_function_id,
+                args,
+                max_steps=limit,
+                deadline=deadline,
+            )
+        except DeadlineReachedError as e:
+            _release(limit, e.steps, finished=True)
+            return "budget", None, None
+
+        if result is not None:
+            outcome = "matched"
+        elif game_steps < limit:
+            outcome = "failed"
+        elif limit == options.max_steps:
+            outcome = "step_limit"
+        else:
+            outcome = None
+        _release(limit, game_steps, finished=outcome is not None)
+
+        if outcome == "matched":
+            return outcome, next(iter(result.matching[query_function_id])), game_steps
+        if outcome is not None:
+            return outcome, None, game_steps
+
+
+def _reserve(limit: int, options: FirmUPImageOptions, deadline: float | None) -> int | None:
+    """Reserves the steps of the next round, whose limit is double the current one.
+    The limit is cut to a fair share of the unreserved step budget, i.e. the unreserved
+    steps divided by the games that wait for a round.
+    Returns None (and gives up the game) if that would not be more than the current limit
+    or if the deadline passed.
+    """
+    next_limit = 2 * limit if limit != 0 else options.initial_steps
+    if options.max_steps is not None:
+        next_limit = min(next_limit, options.max_steps)
+
+    steps = _worker_state["steps"]
+    with steps.get_lock():
+        used, reserved, waiting = steps[0], steps[1], steps[2]
+        if options.step_budget is not None:
+            free = options.step_budget - used - reserved
+            next_limit = min(next_limit, math.ceil(free / max(waiting, 1)))
+        steps[2] = waiting - 1
+        if next_limit <= limit or (deadline is not None and time.monotonic() >= deadline):
+            return None
+        steps[1] = reserved + next_limit
+
+    return next_limit
+
+
+def _release(limit: int, steps: int, finished: bool):
+    """Charges the steps that a round used and releases its reservation.
+    Unless the game is finished, it waits for its next round.
+    """
+    shared_steps = _worker_state["steps"]
+    with shared_steps.get_lock():
+        shared_steps[0] += steps
+        shared_steps[1] -= limit
+        if not finished:
+            shared_steps[2] += 1
@@ -0,0 +1,399 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import array
+import pathlib as pl
+import shutil
+import typing
+
+import msgspec
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
+_SEGMENT_ARRAYS = [
+    # One entry per function, sorted by function id
+    "function_ids",
+    "binary_ids",
+    "norms",
+    # The functions' vectors in CSR format
+    "vector_indptr",
+    "vector_hashes",
+    "vector_tfs",
+    # The posting lists in CSR format, one row per hash
+    "hashes",
+    "posting_indptr",
+    "posting_functions",
+    "posting_tfs",
+]
+
+
+class _Manifest(msgspec.Struct):
+    segments: list[str]
+
+
+class _Vectors(msgspec.Struct):
+    """The vectors of some functions. The hashes and tfs of all vectors are concatenated,
+    lengths is the amount of hashes of every function.
+    """
+
+    function_ids: np.ndarray
+    binary_ids: np.ndarray
+    hashes: np.ndarray
+    tfs: np.ndarray
+    lengths: np.ndarray
+
+    def select(self, mask: np.ndarray) -> "_Vectors":
+        """Returns the vectors of the functions that the mask selects."""
+        positions = np.repeat(mask, self.lengths)
+        return _Vectors(
+            function_ids=self.function_ids[mask],
+            binary_ids=self.binary_ids[mask],
+            hashes=self.hashes[positions],
+            tfs=self.tfs[positions],
+            lengths=self.lengths[mask],
+        )
+
+
+class _Segment:
+    """An immutable part of the index. All arrays are memory-mapped."""
+
+    def __init__(self, path: pl.Path):
+        self.path = path
+        for name in _SEGMENT_ARRAYS:
+            setattr(self, name, np.load(path / f"{name}.npy", mmap_mode="r"))
+
+    def __len__(self) -> int:
+        return len(self.function_ids)
+
+    def locate(self, function_id: int) -> int | None:
+        idx = int(np.searchsorted(self.function_ids, function_id))
+        if idx == len(self.function_ids) or self.function_ids[idx] != function_id:
+            return None
+        return idx
+
+    def vector(self, idx: int) -> tuple[np.ndarray, np.ndarray]:
+        start, stop = self.vector_indptr[idx], self.vector_indptr[idx + 1]
+        return self.vector_hashes[start:stop], self.vector_tfs[start:stop]
+
+    def candidates(
+        self,
+        hashes: np.ndarray,
+        tfs: np.ndarray,
+        max_posting_length: int | None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the indices of all functions that share a hash with the vector
+        and the dot product with the vector.
+        """
+        cols = np.searchsorted(self.hashes, hashes)
+        cols = np.minimum(cols, len(self.hashes) - 1)
+        found = self.hashes[cols] == hashes
+        cols = cols[found]
+        tfs = tfs[found]
+
+        starts = self.posting_indptr[cols]
+        lengths = self.posting_indptr[cols + 1] - starts
+        if max_posting_length is not None:
+            # Very common hashes are not discriminative but expensive to scan
+            common = lengths > max_posting_length
+            starts, lengths, tfs = starts[~common], lengths[~common], tfs[~common]
+
+        positions = _ranges(starts, lengths)
+        functions = self.posting_functions[positions]
+        products = self.posting_tfs[positions] * np.repeat(tfs, lengths)
+
+        idx, inverse = np.unique(functions, return_inverse=True)
+        return idx, np.bincount(inverse, weights=products, minlength=len(idx))
+
+
+class LshIndex:
+    """An inverted index from the lsh feature hashes of every function to the functions.
+    Answers "which functions look like this one" without touching the database.
+
+    Candidates are ranked by the cosine similarity of the hash frequencies.
+    As this ignores BSim's hash weights, it only approximates lshvector_compare.
+    Rescore the candidates with BSim if exact scores are needed.
+
+    The index is a directory of immutable segments of memory-mapped arrays.
+    New binaries are appended as a new segment, see append and compact.
+    """
+
+    def __init__(self, path: pl.Path):
+        self.path = pl.Path(path)
+        manifest = msgspec.json.decode(
+            (self.path / "manifest.json").read_bytes(),
+            type=_Manifest,
+        )
+        self._segments = [_Segment(self.path / name) for name in manifest.segments]
+
+    @classmethod
+    def build(
+        cls,
+        path: pl.Path,
+        session: "m.Session",
+        binary_ids: list[int] | None = None,
+    ) -> "LshIndex":
+        """Creates the index from e."function:all".
+        If binary_ids is given, only these binaries are indexed.
+        """
+        path = pl.Path(path)
+        path.mkdir(parents=True, exist_ok=False)
+        _write_manifest(path, [])
+
+        index = cls(path)
+        index.append(session, binary_ids)
+        return index
+
+    def append(self, session: "m.Session", binary_ids: list[int] | None = None):
+        """Adds the functions of the binaries to the index.
+        Functions that are already indexed are skipped.
+        """
+        vectors = _fetch_vectors(session, binary_ids)
+
+        new = np.ones(len(vectors.function_ids), dtype=bool)
+        for segment in self._segments:
+            new &= ~np.isin(vectors.function_ids, segment.function_ids)
+        if not new.all():
+            vectors = vectors.select(new)
+
+        if len(vectors.function_ids) == 0:
+            return
+
+        name = f"segment-{len(self._segments):04}"
+        while (self.path / name).exists():
+            name += "-"
+        _write_segment(self.path / name, vectors)
+        self._segments.append(_Segment(self.path / name))
+        _write_manifest(self.path, [segment.path.name for segment in self._segments])
+
+    def compact(self):
+        """Merges all segments into a single segment."""
+        if len(self._segments) <= 1:
+            return
+
+        vectors = _Vectors(
+            function_ids=np.concatenate([segment.function_ids for segment in self._segments]),
+            binary_ids=np.concatenate([segment.binary_ids for segment in self._segments]),
+            hashes=np.concatenate([segment.vector_hashes for segment in self._segments]),
+            tfs=np.concatenate([segment.vector_tfs for segment in self._segments]),
+            lengths=np.concatenate([np.diff(segment.vector_indptr) for segment in self._segments]),
+        )
+
+        old = self._segments
+        name = "segment-compact"
+        while (self.path / name).exists():
+            name += "-"
+        _write_segment(self.path / name, vectors)
+        self._segments = [_Segment(self.path / name)]
+        _write_manifest(self.path, [name])
+
+        for segment in old:
+            shutil.rmtree(segment.path)
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self._segments)
+
+    def __contains__(self, function_id: int) -> bool:
+        return any(segment.locate(function_id) is not None for segment in self._segments)
+
+    def vector(self, function_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the hashes and hash frequencies of the function."""
+        for segment in self._segments:
+            idx = segment.locate(function_id)
+            if idx is not None:
+                return segment.vector(idx)
+
+        raise KeyError(f"Function {function_id} is not indexed")
+
+    def top_k(
+        self,
+        function_id: int,
+        k: int,
+        binary_ids: list[int] | None = None,
+        max_posting_length: int | None = None,
+    ) -> pd.DataFrame:
+        """Returns the k most similar functions with the columns function_id, binary_id and score.
+        The function itself is excluded.
+        If binary_ids is given, only functions of these binaries are returned.
+        """
+        hashes, tfs = self.vector(function_id)
+        norm = np.sqrt(np.sum(np.square(tfs, dtype=np.float64)))
+
+        frames = []
+        for segment in self._segments:
+            idx, dots = segment.candidates(hashes, tfs, max_posting_length)
+            candidate_ids = np.asarray(segment.function_ids[idx])
+            candidate_binary_ids = np.asarray(segment.binary_ids[idx])
+
+            keep = candidate_ids != function_id
+            if binary_ids is not None:
+                keep &= np.isin(candidate_binary_ids, binary_ids)
+            idx, dots = idx[keep], dots[keep]
+
+            scores = dots / (norm * segment.norms[idx])
+            best = _top_k_indices(scores, k)
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "function_id": candidate_ids[keep][best],
+                        "binary_id": candidate_binary_ids[keep][best],
+                        "score": scores[best],
+                    }
+                )
+            )
+
+        frame = pd.concat(frames, ignore_index=True)
+        return (
+            frame.sort_values(["score", "function_id"], ascending=[False, True])
+            .head(k)
+            .reset_index(drop=True)
+        )
+
+    def top_k_batch(
+        self,
+        function_ids: list[int],
+        k: int,
+        binary_ids: list[int] | None = None,
+        max_posting_length: int | None = None,
+    ) -> pd.DataFrame:
+        """Like top_k for every function.
+        The result has an additional query_function_id column.
+        """
+        frames = [
+            self.top_k(
+                function_id,
+                k,
+                binary_ids=binary_ids,
+                max_posting_length=max_posting_length,
+            ).assign(query_function_id=function_id)
+            for function_id in function_ids
+        ]
+
+        return pd.concat(frames, ignore_index=True)[
+            ["query_function_id", "function_id", "binary_id", "score"]
+        ]
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    if len(scores) <= k:
+        return np.arange(len(scores))
+    return np.argpartition(-scores, k)[:k]
+
+
+def _ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Concatenates np.arange(start, start + length) for all starts and lengths."""
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + (np.arange(total) - offsets)
+
+
+def _parse_vector(text: str) -> tuple[list[int], list[int]]:
+    """Parses the text representation of an lshvector, e.g. '(1:b30123b6,2:c59bb005)'."""
+    hashes = []
+    tfs = []
+    for item in text.strip("()").split(","):
+        if not item:
+            continue
+        tf, hash_ = item.split(":")
+        tfs.append(int(tf))
+        hashes.append(int(hash_, 16))
+
+    return hashes, tfs
+
+
+def _fetch_vectors(session: "m.Session", binary_ids: list[int] | None) -> _Vectors:
+    stmt = sa.text(
+        """
+        SELECT f.id, f.binary_id, f.vector::text
+        FROM e."function:all" f
+        WHERE f.vector IS NOT NULL
+            AND (CAST(:binary_ids AS bigint[]) IS NULL OR f.binary_id = ANY(:binary_ids))
+        ORDER BY f.id
+        """
+    )
+
+    function_ids = array.array("q")
+    binary_ids_ = array.array("q")
+    lengths = array.array("q")
+    hashes = array.array("L")
+    tfs = array.array("f")
+    result = session.execute(
+        stmt,
+        {"binary_ids": binary_ids},
+        execution_options={"yield_per": 100_000},
+    )
+    for function_id, binary_id, text in result:
+        vector_hashes, vector_tfs = _parse_vector(text)
+        function_ids.append(function_id)
+        binary_ids_.append(binary_id)
+        lengths.append(len(vector_hashes))
+        hashes.extend(vector_hashes)
+        tfs.extend(vector_tfs)
+
+    return _Vectors(
+        function_ids=np.frombuffer(function_ids, dtype=np.int64),
+        binary_ids=np.frombuffer(binary_ids_, dtype=np.int64),
+        hashes=np.asarray(hashes, dtype=np.uint32),
+        tfs=np.frombuffer(tfs, dtype=np.float32),
+        lengths=np.frombuffer(lengths, dtype=np.int64),
+    )
+
+
+def _write_segment(path: pl.Path, vectors: _Vectors):
+    # Sort functions by id to find them with a binary search
+    order = np.argsort(vectors.function_ids, kind="stable")
+    vector_positions = _ranges(
+        (np.cumsum(vectors.lengths) - vectors.lengths)[order],
+        vectors.lengths[order],
+    )
+    function_ids = vectors.function_ids[order]
+    binary_ids = vectors.binary_ids[order]
+    lengths = vectors.lengths[order]
+    hashes = vectors.hashes[vector_positions]
+    tfs = vectors.tfs[vector_positions]
+
+    vector_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    functions = np.repeat(np.arange(len(function_ids), dtype=np.int32), lengths)
+    # Unlike np.add.reduceat, bincount gives empty vectors a sum of zero
+    norms = np.sqrt(
+        np.bincount(
+            functions,
+            weights=np.square(tfs, dtype=np.float64),
+            minlength=len(function_ids),
+        )
+    )
+    norms[lengths == 0] = np.inf
+
+    posting_order = np.argsort(hashes, kind="stable")
+    unique_hashes, counts = np.unique(hashes[posting_order], return_counts=True)
+
+    arrays = {
+        "function_ids": function_ids,
+        "binary_ids": binary_ids,
+        "norms": norms.astype(np.float32),
+        "vector_indptr": vector_indptr,
+        "vector_hashes": hashes,
+        "vector_tfs": tfs,
+        "hashes": unique_hashes,
+        "posting_indptr": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        "posting_functions": functions[posting_order],
+        "posting_tfs": tfs[posting_order],
+    }
+
+    path.mkdir(parents=True)
+    for name, values in arrays.items():
+        np.save(path / f"{name}.npy", values)
+
+
+def _write_manifest(path: pl.Path, segments: list[str]):
+    tmp_path = path / "manifest.json.tmp"
+    tmp_path.write_bytes(msgspec.json.encode(_Manifest(segments=segments)))
+    tmp_path.replace(path / "manifest.json")
@@ -300,3 +300,105 @@ class Features(Base):
         index=True,
     )
     # XXX This is missing the section name and hash
+
+
+@sau.generic_repr
+class ScoringJob(Base):
+    """A binary pair of a dataset that is scored by a worker (see evaluatie.workqueue)."""
+
+    __tablename__ = "scoring_job"
+
+    id: Mapped[int] = mapped_column(
+        primary_key=True,
+        index=True,
+    )
+    query_binary_id: Mapped[int] = mapped_column()
+    target_binary_id: Mapped[int] = mapped_column()
+    #: The name of the dataset, i.e. the table in the 'd' schema.
+    dataset: Mapped[str] = mapped_column()
+    #: Either 'neighbsim' or 'firmup'
+    method: Mapped[str] = mapped_column()
+
+    #: One of 'pending', 'running', 'done' or 'failed'
+    status: Mapped[str] = mapped_column(
+        index=True,
+        default="pending",
+    )
+    #: The worker that claimed the job last
+    worker: Mapped[str] = mapped_column(
+        nullable=True,
+        index=True,
+    )
+    #: How often the job was claimed
+    attempts: Mapped[int] = mapped_column(
+        default=0,
+    )
+    #: A running job whose lease expired is considered abandoned and can be claimed again.
+    lease_expires_at = mapped_column(
+        sa.DateTime(timezone=True),
+        nullable=True,
+    )
+    heartbeat_at = mapped_column(
+        sa.DateTime(timezone=True),
+        nullable=True,
+    )
+    started_at = mapped_column(
+        sa.DateTime(timezone=True),
+        nullable=True,
+    )
+    finished_at = mapped_column(
+        sa.DateTime(timezone=True),
+        nullable=True,
+    )
+    #: The amount of results that the job produced
+    row_count: Mapped[int] = mapped_column(
+        nullable=True,
+    )
+    #: The error of the last failed attempt
+    error: Mapped[str] = mapped_column(
+        nullable=True,
+    )
+
+    __table_args__ = (
+        sa.UniqueConstraint(
+            query_binary_id,
+            target_binary_id,
+            dataset,
+            method,
+        ),
+    )
+
+
+@sau.generic_repr
+class ScoringResult(Base):
+    __tablename__ = "scoring_result"
+
+    id: Mapped[int] = mapped_column(
+        primary_key=True,
+    )
+    job_id: Mapped[int] = mapped_column(
+        sa.ForeignKey("scoring_job.id", ondelete="CASCADE"),
+        index=True,
+    )
+    query_function_id: Mapped[int] = mapped_column(
+        index=True,
+    )
+    #: For 'neighbsim' the scored target function.
+    #: For 'firmup' the matched target function or NULL if the game failed.
+    target_function_id: Mapped[int] = mapped_column(
+        nullable=True,
+        index=True,
+    )
+    #: Whether target_function_id is the positive target. NULL for 'firmup'.
+    label: Mapped[bool] = mapped_column(
+        nullable=True,
+    )
+    #: The neighbsim score. NULL for 'firmup' and rows that could not be scored.
+    score: Mapped[float] = mapped_column(
+        nullable=True,
+    )
+    #: The number of steps of the firmup game.
+    #: NULL for 'neighbsim' and if the step limit was reached.
+    steps: Mapped[int] = mapped_column(
+        nullable=True,
+    )
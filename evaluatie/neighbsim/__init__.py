@@ -1,5 +1,6 @@
-from .neighbsim import neighbsim
+from .neighbsim import neighbsim, neighbsim_topk
 
 __all__ = [
     "neighbsim",
+    "neighbsim_topk",
 ]
\ No newline at end of file
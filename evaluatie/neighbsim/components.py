@@ -0,0 +1,200 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import itertools
+import pathlib as pl
+import typing
+
+import msgspec
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+from evaluatie.data import FunctionDataset, load_pickle_columns
+
+#: The parts that the neighbsim score is computed from.
+#: Scoring stores these in the dataset's pickle, see scoring.RESULT_COLUMNS.
+COMPONENT_COLUMNS = [
+    "bsim_weight",
+    "caller_sum",
+    "callee_sum",
+    "qcaller_count",
+    "tcaller_count",
+    "qcallee_count",
+    "tcallee_count",
+]
+
+#: Counts are nullable, as rows that could not be scored have no components.
+COMPONENT_DTYPES = {
+    "bsim_weight": np.float32,
+    "caller_sum": np.float32,
+    "callee_sum": np.float32,
+    "qcaller_count": pd.Int32Dtype(),
+    "tcaller_count": pd.Int32Dtype(),
+    "qcallee_count": pd.Int32Dtype(),
+    "tcallee_count": pd.Int32Dtype(),
+}
+
+
+class ScoreComponents(msgspec.Struct):
+    """The score components of every scored row of a dataset as flat arrays."""
+
+    label: np.ndarray
+
+    bsim_weight: np.ndarray
+    caller_sum: np.ndarray
+    callee_sum: np.ndarray
+
+    qcaller_count: np.ndarray
+    tcaller_count: np.ndarray
+    qcallee_count: np.ndarray
+    tcallee_count: np.ndarray
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "ScoreComponents":
+        """Expects the columns label and COMPONENT_COLUMNS.
+        Rows that were not scored are dropped.
+        """
+        frame = frame[["label", *COMPONENT_COLUMNS]].dropna()
+        return cls(
+            label=frame["label"].to_numpy(dtype=bool),
+            **{
+                column: frame[column].to_numpy(
+                    dtype=np.int32 if column.endswith("_count") else np.float32
+                )
+                for column in COMPONENT_COLUMNS
+            },
+        )
+
+    @classmethod
+    def from_name(cls, name: str) -> "ScoreComponents":
+        """Loads the components of the named dataset.
+        The components are cached next to the dataset's pickle, see save.
+        """
+        pickle_path = pl.Path("datasets", f"{name}.pickle.gz")
+        path = pl.Path("datasets", f"{name}.components.npz")
+        if not pickle_path.exists():
+            raise ValueError(
+                f"The components of {name} are computed from {pickle_path} (cached in {path}),"
+                " but it was not found."
+            )
+        if path.exists() and path.stat().st_mtime >= pickle_path.stat().st_mtime:
+            return cls.load(path)
+
+        frame = FunctionDataset.from_name(name).frame[["label"]]
+        components = cls.from_frame(
+            pd.concat([frame, load_pickle_columns(name, COMPONENT_COLUMNS)], axis=1)
+        )
+        components.save(path)
+
+        return components
+
+    @classmethod
+    def load(cls, path: pl.Path) -> "ScoreComponents":
+        with np.load(path) as npz:
+            return cls(**{field: npz[field] for field in cls.__struct_fields__})
+
+    def save(self, path: pl.Path):
+        np.savez(path, **{field: getattr(self, field) for field in self.__struct_fields__})
+
+    def __len__(self) -> int:
+        return len(self.label)
+
+    @property
+    def neighbor_count(self) -> np.ndarray:
+        return self.qcaller_count + self.tcaller_count + self.qcallee_count + self.tcallee_count
+
+
+def neighbsim_score(components: ScoreComponents) -> np.ndarray:
+    """The score that neighbsim computes, see neighbsim.neighbsim."""
+    return (
+        2
+        * (components.bsim_weight + components.caller_sum + components.callee_sum)
+        / (2 + components.neighbor_count)
+    )
+
+
+def auc(scores: np.ndarray, label: np.ndarray) -> np.ndarray:
+    """Computes the ROC AUC of every row of scores.
+    Equal to sklearn.metrics.roc_auc_score(label, scores[i]) for every i.
+    """
+    scores = np.atleast_2d(scores)
+    label = np.asarray(label, dtype=bool)
+    positive_count = label.sum()
+    negative_count = len(label) - positive_count
+
+    ranks = scipy.stats.rankdata(scores, axis=1)
+    rank_sum = ranks[:, label].sum(axis=1)
+    return (rank_sum - positive_count * (positive_count + 1) / 2) / (
+        positive_count * negative_count
+    )
+
+
+def sweep(
+    components: ScoreComponents,
+    formulas: dict[str, typing.Callable[[ScoreComponents], np.ndarray]],
+) -> pd.DataFrame:
+    """Evaluates every formula on all rows of the components.
+    A formula maps the components to one score per row, e.g. neighbsim_score.
+    Returns a frame with the columns variant and auc.
+    """
+    return pd.DataFrame(
+        {
+            "variant": list(formulas.keys()),
+            "auc": [
+                auc(formula(components), components.label)[0]
+                for formula in formulas.values()
+            ],
+        }
+    )
+
+
+class WeightGrid(msgspec.Struct, frozen=True):
+    """The weights that weight_grid combines.
+    If normalize is set, the weighted sum is normalized like neighbsim normalizes its score.
+    """
+
+    bsim_weights: list[float]
+    caller_weights: list[float]
+    callee_weights: list[float]
+    normalize: bool = True
+
+
+def weight_grid(
+    components: ScoreComponents,
+    grid: WeightGrid,
+    chunk_size: int = 2**26,
+) -> pd.DataFrame:
+    """Evaluates every combination of weights for the bsim weight, the caller sum
+    and the callee sum.
+    Returns a frame with the columns bsim_weight, caller_weight, callee_weight and auc.
+
+    Scores of as many variants as fit in chunk_size values are computed at once.
+    """
+    weights = np.array(
+        list(itertools.product(grid.bsim_weights, grid.caller_weights, grid.callee_weights)),
+        dtype=np.float32,
+    ).reshape(-1, 3)
+    values = np.stack(
+        [components.bsim_weight, components.caller_sum, components.callee_sum]
+    )
+    denominator = (2 + components.neighbor_count).astype(np.float32)
+
+    step = max(1, chunk_size // max(1, len(components)))
+    aucs = []
+    for start in range(0, len(weights), step):
+        scores = weights[start : start + step] @ values
+        if grid.normalize:
+            scores /= denominator
+        aucs.append(auc(scores, components.label))
+
+    return pd.DataFrame(
+        {
+            "bsim_weight": weights[:, 0],
+            "caller_weight": weights[:, 1],
+            "callee_weight": weights[:, 2],
+            "auc": np.concatenate(aucs) if aucs else np.empty(0),
+        }
+    )
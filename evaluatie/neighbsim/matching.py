@@ -0,0 +1,317 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""Maximum weight matchings of the callers (or callees) of two functions.
+
+The exact matching is cubic in the neighbourhood size, which makes hub functions
+(dispatchers, main, error handlers) dominate the runtime of scoring.
+For these, an auction with an epsilon bound or a greedy matching can be used.
+Every matching comes with an upper bound of how much lighter it is than the exact one.
+"""
+
+import collections
+import logging
+import typing
+
+import msgspec
+import networkx as nx
+import numpy as np
+from networkx.algorithms.bipartite.matching import minimum_weight_full_matching
+
+#: The matching algorithms, from the most to the least exact.
+ALGORITHMS = ["exact", "auction", "greedy"]
+
+Algorithm = typing.Literal["auto", "exact", "auction", "greedy"]
+
+
+class MatchingOptions(msgspec.Struct, frozen=True):
+    """Selects the algorithm that matches the neighbours of a function pair.
+
+    The default is the exact matching, approximations must be selected explicitly.
+    With "auto", the algorithm is chosen by the size of the neighbourhoods:
+    The exact matching if its cost fits into the budget, else the auction if a
+    single bid per neighbour fits into the budget, else the greedy matching.
+    """
+
+    algorithm: Algorithm = "exact"
+    #: The amount by which a bid must exceed the current price in the auction.
+    #: The auction's matching is at most min(len(left), len(right)) * epsilon lighter
+    #: than the exact matching.
+    epsilon: float = 1e-3
+    #: The work a single matching may take, in similarity comparisons.
+    #: The exact matching takes about len(left) * len(right) * min(len(left), len(right)),
+    #: a bid in the auction max(len(left), len(right)).
+    #: The auction stops bidding when the budget is exhausted and matches the rest greedily.
+    budget: int = 2**20
+
+    def select(self, left_count: int, right_count: int) -> str:
+        if self.algorithm != "auto":
+            return self.algorithm
+
+        small, large = sorted([left_count, right_count])
+        if small * small * large <= self.budget:
+            return "exact"
+        if small * large <= self.budget:
+            return "auction"
+        return "greedy"
+
+
+class Matching(msgspec.Struct, frozen=True):
+    #: The matched pairs with the corresponding weights
+    graph: nx.Graph
+    #: The algorithm that computed the matching, one of ALGORITHMS
+    algorithm: str
+    #: An upper bound of the difference between the weight of the exact matching and this one
+    error_bound: float
+    #: The sum of the similarities of matched pairs
+    weight: float
+
+
+class MatchingMemoStats(msgspec.Struct, frozen=True):
+    hits: int
+    misses: int
+    #: How often the memo was cleared, because the similarity graph changed
+    clears: int
+    size: int
+    capacity: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __str__(self) -> str:
+        return (
+            f"Matching memo: {self.hits} hits, {self.misses} misses"
+            f" ({self.hit_rate:.1%} hit rate), cleared {self.clears} times"
+        )
+
+
+class MatchingMemo:
+    """Remembers the matchings of neighbour sets.
+
+    Many function pairs of a binary pair have the same callers or callees, e.g. wrappers or
+    negatives that are sampled from the same neighbourhood.
+    Matchings are keyed by the sets of left and right functions and the options.
+    The memo belongs to a single similarity graph, and is cleared when it is used with
+    another one (i.e. with the args of another binary pair).
+
+    Matchings with equal weight can differ in the matched pairs from the matching that
+    match would compute for differently ordered neighbours, the weight is always equal.
+    Cached matchings are shared and must not be modified.
+    """
+
+    def __init__(self, capacity: int = 2**16):
+        self.capacity = capacity
+        self._similarity_graph: nx.Graph | None = None
+        self._key2matching: collections.OrderedDict[tuple, Matching] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.clears = 0
+
+    def match(
+        self,
+        left: list[int],
+        right: list[int],
+        similarity_graph: nx.Graph,
+        options: MatchingOptions = MatchingOptions(),
+    ) -> Matching:
+        if similarity_graph is not self._similarity_graph:
+            if self._similarity_graph is not None:
+                self.clears += 1
+            self._key2matching.clear()
+            self._similarity_graph = similarity_graph
+
+        key = (frozenset(left), frozenset(right), options)
+        matching = self._key2matching.get(key)
+        if matching is not None:
+            self._key2matching.move_to_end(key)
+            self.hits += 1
+            return matching
+
+        self.misses += 1
+        matching = match(left, right, similarity_graph, options)
+        self._key2matching[key] = matching
+        if len(self._key2matching) > self.capacity:
+            self._key2matching.popitem(last=False)
+
+        return matching
+
+    def stats(self) -> MatchingMemoStats:
+        return MatchingMemoStats(
+            hits=self.hits,
+            misses=self.misses,
+            clears=self.clears,
+            size=len(self._key2matching),
+            capacity=self.capacity,
+        )
+
+
+def match(
+    left: list[int],
+    right: list[int],
+    similarity_graph: nx.Graph,
+    options: MatchingOptions = MatchingOptions(),
+) -> Matching:
+    """Matches left to right maximizing the sum of the similarities of matched pairs."""
+    algorithm = options.select(len(left), len(right))
+
+    g = nx.Graph()
+    g.add_nodes_from(left)
+    g.add_nodes_from(right)
+
+    if len(left) == 0 or len(right) == 0:
+        return Matching(graph=g, algorithm=algorithm, error_bound=0.0, weight=0.0)
+
+    if algorithm == "exact":
+        _exact(left, right, similarity_graph, g)
+        return Matching(graph=g, algorithm=algorithm, error_bound=0.0, weight=_weight(g))
+
+    weights = _weight_matrix(left, right, similarity_graph)
+    # The matrix is transposed if needed, so that rows are the smaller side
+    transposed = len(left) > len(right)
+    if transposed:
+        weights = weights.T
+
+    if algorithm == "auction":
+        assignment, a_priori_bound = _auction(weights, options.epsilon, options.budget)
+    elif algorithm == "greedy":
+        assignment = _greedy(weights)
+        a_priori_bound = None
+    else:
+        raise ValueError(f"Unknown matching algorithm {algorithm}")
+
+    rows = np.flatnonzero(assignment >= 0)
+    cols = assignment[rows]
+    matched_weights = weights[rows, cols]
+    total = float(matched_weights.sum())
+
+    for row, col, weight in zip(rows.tolist(), cols.tolist(), matched_weights.tolist()):
+        u, v = (right[row], left[col]) if transposed else (left[row], right[col])
+        # Pairs without similarity were only matched to fill the matching
+        if similarity_graph.has_edge(u, v):
+            g.add_edge(u, v, weight=weight)
+
+    # Every neighbour is matched at most once,
+    # so the exact matching is at most the sum of every neighbour's best similarity.
+    upper_bound = float(min(weights.max(axis=1).sum(), weights.max(axis=0).sum()))
+    error_bound = upper_bound - total
+    if algorithm == "greedy":
+        # The greedy matching is a 1/2-approximation
+        error_bound = min(error_bound, total)
+    if a_priori_bound is not None:
+        error_bound = min(error_bound, a_priori_bound)
+
+    return Matching(
+        graph=g,
+        algorithm=algorithm,
+        error_bound=max(error_bound, 0.0),
+        weight=_weight(g),
+    )
+
+
+def _weight(graph: nx.Graph) -> float:
+    return sum(data["weight"] for _, _, data in graph.edges(data=True))
+
+
+def _exact(left: list[int], right: list[int], similarity_graph: nx.Graph, g: nx.Graph):
+    mg = similarity_graph.subgraph(left + right).copy()
+    for u, v, data in mg.edges(data=True):
+        edge = (u, v)
+        mg.edges[edge]["weight"] = -data["weight"]
+
+    if len(mg.edges) != len(left) * len(right):
+        logging.error(
+            "Similarity graph is missing edges.\n"
+            f"Edges: {mg.edges}\n"
+            f"Left: {left}\n"
+            f"Right: {right}\n"
+        )
+
+    m = minimum_weight_full_matching(mg, top_nodes=left)
+
+    g.add_edges_from(m.items())
+    for edge in m.items():
+        g.edges[edge]["weight"] = similarity_graph.edges[edge]["weight"]
+
+
+def _weight_matrix(left: list[int], right: list[int], similarity_graph: nx.Graph) -> np.ndarray:
+    """Missing similarities are zero."""
+    weights = np.zeros((len(left), len(right)), dtype=np.float64)
+    right_positions = {function_id: position for position, function_id in enumerate(right)}
+    for row, function_id in enumerate(left):
+        if function_id not in similarity_graph:
+            continue
+        for other_id, data in similarity_graph[function_id].items():
+            col = right_positions.get(other_id)
+            if col is not None:
+                weights[row, col] = data["weight"]
+
+    return weights
+
+
+def _greedy(weights: np.ndarray) -> np.ndarray:
+    """Returns the column assigned to every row (or -1).
+    Pairs are matched by decreasing weight, ties in row-major order.
+    """
+    assignment = np.full(weights.shape[0], -1, dtype=np.int64)
+    taken = np.zeros(weights.shape[1], dtype=bool)
+    remaining = weights.shape[0]
+    for position in np.argsort(-weights, axis=None, kind="stable").tolist():
+        row, col = divmod(position, weights.shape[1])
+        if assignment[row] != -1 or taken[col]:
+            continue
+        assignment[row] = col
+        taken[col] = True
+        remaining -= 1
+        if remaining == 0:
+            break
+
+    return assignment
+
+
+def _auction(weights: np.ndarray, epsilon: float, budget: int) -> tuple[np.ndarray, float | None]:
+    """The forward auction of Bertsekas for at most as many rows as columns.
+    Returns the column assigned to every row and the a-priori error bound,
+    which is None if the budget was exhausted and the rest was matched greedily.
+    """
+    row_count, col_count = weights.shape
+    # All prices start equal, which makes the auction correct for fewer rows than columns
+    prices = np.zeros(col_count, dtype=np.float64)
+    assignment = np.full(row_count, -1, dtype=np.int64)
+    owner = np.full(col_count, -1, dtype=np.int64)
+
+    max_bids = max(budget // col_count, row_count)
+    bids = 0
+    unassigned = list(range(row_count - 1, -1, -1))
+    while len(unassigned) != 0 and bids < max_bids:
+        row = unassigned.pop()
+        bids += 1
+
+        values = weights[row] - prices
+        best = int(np.argmax(values))
+        if col_count == 1:
+            increment = epsilon
+        else:
+            best_value = values[best]
+            values[best] = -np.inf
+            increment = best_value - values.max() + epsilon
+
+        prices[best] += increment
+        previous = owner[best]
+        if previous != -1:
+            assignment[previous] = -1
+            unassigned.append(previous)
+        owner[best] = row
+        assignment[row] = best
+
+    if len(unassigned) == 0:
+        return assignment, row_count * epsilon
+
+    rest = np.array(sorted(unassigned), dtype=np.int64)
+    free = np.flatnonzero(owner == -1)
+    rest_assignment = _greedy(weights[np.ix_(rest, free)])
+    assignment[rest] = np.where(rest_assignment >= 0, free[rest_assignment], -1)
+
+    return assignment, None
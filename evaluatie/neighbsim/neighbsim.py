@@ -1,13 +1,20 @@
+import collections
+import heapq
+import itertools
 import logging
+import typing
 
 import msgspec
 import networkx as nx
+import numpy as np
 import sqlalchemy as sa
-from networkx.algorithms.bipartite.matching import minimum_weight_full_matching
 
-from evaluatie import models as m
+from evaluatie.neighbsim.matching import MatchingMemo, MatchingOptions, match
 from evaluatie.utils import call_graph_from_binary_id
 
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
 
 class NeighBSimArgs(msgspec.Struct, frozen=True):
     """A collection of data that is needed for neighbsim score calculation."""
@@ -40,37 +47,31 @@ class NeighBSimResult(msgspec.Struct, frozen=True):
 
     score: float
 
-
-def _matching_graph(left: list[int], right: list[int], similarity_graph: nx.Graph):
-    g = nx.Graph()
-    g.add_nodes_from(left)
-    g.add_nodes_from(right)
-
-    if len(left) == 0:
-        return g
-    if len(right) == 0:
-        return g
-
-    mg = similarity_graph.subgraph(left + right).copy()
-    for u, v, data in mg.edges(data=True):
-        edge = (u, v)
-        mg.edges[edge]["weight"] = -data["weight"]
-
-    if len(mg.edges) != len(left) * len(right):
-        logging.error(
-            "Similarity graph is missing edges.\n"
-            f"Edges: {mg.edges}\n"
-            f"Left: {left}\n"
-            f"Right: {right}\n"
+    #: The similarity of the query and the target function
+    bsim: float
+
+    #: The algorithms that matched the callers and callees, see matching.ALGORITHMS
+    caller_matching_algorithm: str = "exact"
+    callee_matching_algorithm: str = "exact"
+    #: Upper bounds of how much lighter the matchings are than the exact matchings
+    caller_error_bound: float = 0.0
+    callee_error_bound: float = 0.0
+
+    @property
+    def score_error_bound(self) -> float:
+        """An upper bound of how much lower the score is than the score with exact matchings."""
+        node_count = (
+            2 + len(self.qcallers) + len(self.tcallers) + len(self.qcallees) + len(self.tcallees)
         )
+        return 2 * (self.caller_error_bound + self.callee_error_bound) / node_count
 
-    m = minimum_weight_full_matching(mg, top_nodes=left)
-
-    g.add_edges_from(m.items())
-    for edge in m.items():
-        g.edges[edge]["weight"] = similarity_graph.edges[edge]["weight"]
+    @property
+    def caller_sum(self) -> float:
+        return _edge_weight_sum(self.caller_matching)
 
-    return g
+    @property
+    def callee_sum(self) -> float:
+        return _edge_weight_sum(self.callee_matching)
 
 
 def _edge_weight_sum(graph: nx.Graph):
@@ -81,7 +82,13 @@ def neighbsim(
     query_function_id,
     target_function_id,
     args: NeighBSimArgs,
+    matching: MatchingOptions = MatchingOptions(),
+    memo: MatchingMemo | None = None,
 ) -> NeighBSimResult:
+    """Scores the function pair.
+    The callers and callees are matched with the algorithm selected by matching.
+    Pass a memo to reuse the matchings of neighbour sets between function pairs.
+    """
     qcg = args.query_call_graph
     tcg = args.target_call_graph
     sg = args.similarity_graph
@@ -119,8 +126,12 @@ def neighbsim(
     except ValueError:
         pass
 
-    caller_matching = _matching_graph(qcallers, tcallers, sg)
-    callee_matching = _matching_graph(qcallees, tcallees, sg)
+    match_ = match if memo is None else memo.match
+    caller_match = match_(qcallers, tcallers, sg, matching)
+    callee_match = match_(qcallees, tcallees, sg, matching)
+    caller_matching = caller_match.graph
+    callee_matching = callee_match.graph
+    bsim = sg.get_edge_data(query_function_id, target_function_id)["weight"]
 
     # fmt: off
     # Calculate the score of the matching that matches callers to callers,
@@ -132,9 +143,9 @@ def neighbsim(
         # For perfectly, equal graphs, the amount of nodes would be twice the amount of edges.
         # For non-perfect graphs, this penalizes unmatched nodes.
         2 * (
-            sg.get_edge_data(query_function_id, target_function_id)["weight"]
-            + _edge_weight_sum(caller_matching)
-            + _edge_weight_sum(callee_matching)
+            bsim
+            + caller_match.weight
+            + callee_match.weight
         ) / (
             2 +
             len(qcallers) +
@@ -147,15 +158,151 @@ def neighbsim(
     return NeighBSimResult(
         args=args,
         score=score,
+        bsim=bsim,
         callee_matching=callee_matching,
         caller_matching=caller_matching,
         qcallers=qcallers,
         tcallers=tcallers,
         qcallees=qcallees,
         tcallees=tcallees,
+        caller_matching_algorithm=caller_match.algorithm,
+        callee_matching_algorithm=callee_match.algorithm,
+        caller_error_bound=caller_match.error_bound,
+        callee_error_bound=callee_match.error_bound,
     )
 
 
+class NeighBSimTopK(msgspec.Struct, frozen=True):
+    #: The best target functions, ordered by decreasing score and then by id
+    target_function_ids: list[int]
+    results: list[NeighBSimResult]
+
+    #: The amount of target functions that have a similarity with the query
+    candidate_count: int
+    #: The amount of target functions that were scored
+    scored_count: int
+
+
+def neighbsim_topk(
+    query_function_id: int,
+    args: NeighBSimArgs,
+    k: int,
+    tolerance: float = 1e-9,
+) -> NeighBSimTopK:
+    """Returns the k target functions with the highest neighbsim score for the query.
+    Candidates are all functions of the target call-graph that have a similarity with the query.
+
+    The result is the same as scoring every candidate with exact matchings, but
+    candidates are scored in the order of an upper bound of their score and scoring
+    stops as soon as no remaining candidate can enter the top k.
+    The bound replaces each matching by the best similarities of the neighbours
+    that can be matched, see _MatchingBound.
+    Bounds within tolerance of the k-th score are scored, to be safe against rounding.
+    For k <= 0, the result is empty and nothing is scored.
+    """
+    qcg = args.query_call_graph
+    tcg = args.target_call_graph
+    sg = args.similarity_graph
+    matching = MatchingOptions(algorithm="exact")
+
+    candidates = np.array(
+        sorted(target_id for target_id in sg[query_function_id] if target_id in tcg),
+        dtype=np.int64,
+    )
+    bsim = np.array(
+        [sg[query_function_id][target_id]["weight"] for target_id in candidates.tolist()],
+        dtype=np.float64,
+    )
+
+    if k <= 0:
+        return NeighBSimTopK(
+            target_function_ids=[],
+            results=[],
+            candidate_count=len(candidates),
+            scored_count=0,
+        )
+
+    qcallers = set(qcg.predecessors(query_function_id)) - {query_function_id}
+    qcallees = set(qcg.successors(query_function_id)) - {query_function_id}
+    caller_bound = _MatchingBound(qcallers, tcg, sg)
+    callee_bound = _MatchingBound(qcallees, tcg, sg)
+
+    bounds = np.empty(len(candidates), dtype=np.float64)
+    for position, target_id in enumerate(candidates.tolist()):
+        tcallers = set(tcg.predecessors(target_id)) - {target_id}
+        tcallees = set(tcg.successors(target_id)) - {target_id}
+        node_count = 2 + len(qcallers) + len(qcallees) + len(tcallers) + len(tcallees)
+        bounds[position] = (
+            2
+            * (bsim[position] + caller_bound(tcallers) + callee_bound(tcallees))
+            / node_count
+        )
+
+    # Ties are broken by the target function id, which candidates are sorted by
+    order = np.argsort(-bounds, kind="stable")
+
+    # A min-heap of the best k as (score, -target_function_id, result)
+    heap: list[tuple[float, int, NeighBSimResult]] = []
+    scored_count = 0
+    for position in order.tolist():
+        if len(heap) == k and bounds[position] < heap[0][0] - tolerance:
+            break
+
+        target_id = int(candidates[position])
+        result = neighbsim(query_function_id, target_id, args, matching=matching)
+        scored_count += 1
+        entry = (result.score, -target_id, result)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    best = sorted(heap, key=lambda entry: (-entry[0], -entry[1]))
+    return NeighBSimTopK(
+        target_function_ids=[-negative_id for _, negative_id, _ in best],
+        results=[result for _, _, result in best],
+        candidate_count=len(candidates),
+        scored_count=scored_count,
+    )
+
+
+class _MatchingBound:
+    """Bounds the weight of a matching of the query neighbours with some target functions.
+
+    Every function is matched at most once, so a matching weighs at most the sum of the
+    best similarities of the matched query neighbours, and also at most the sum of the
+    best similarities (to any query neighbour) of the matched target functions.
+    """
+
+    def __init__(self, query_neighbors: set[int], tcg: nx.DiGraph, sg: nx.Graph):
+        self.query_neighbor_count = len(query_neighbors)
+        #: Maps target functions to their best similarity to any query neighbour
+        self.target_best: dict[int, float] = {}
+
+        query_best = []
+        for function_id in query_neighbors:
+            best = 0.0
+            if function_id in sg:
+                for other_id, data in sg[function_id].items():
+                    if other_id not in tcg:
+                        continue
+                    best = max(best, data["weight"])
+                    if data["weight"] > self.target_best.get(other_id, 0.0):
+                        self.target_best[other_id] = data["weight"]
+            query_best.append(best)
+
+        #: The i-th element is the sum of the i largest best similarities of query neighbours
+        self.query_prefix = np.concatenate([[0.0], np.cumsum(sorted(query_best, reverse=True))])
+
+    def __call__(self, target_neighbors: set[int]) -> float:
+        count = min(len(target_neighbors), self.query_neighbor_count)
+        target_best = sorted(
+            (self.target_best.get(target_id, 0.0) for target_id in target_neighbors),
+            reverse=True,
+        )
+        return min(self.query_prefix[count], sum(target_best[:count]))
+
+
 class NeighBSimLazyArgs(msgspec.Struct):
     query_binary_id: int
     query_call_graph: nx.DiGraph
@@ -164,7 +311,7 @@ class NeighBSimLazyArgs(msgspec.Struct):
     target_call_graph: nx.DiGraph
 
     @classmethod
-    def from_binary_ids(cls, query_binary_id: int, target_binary_id: int, session: m.Session):
+    def from_binary_ids(cls, query_binary_id: int, target_binary_id: int, session: "m.Session"):
         return cls(
             query_binary_id=query_binary_id,
             target_binary_id=target_binary_id,
@@ -177,10 +324,11 @@ def neighbsim_lazy(
     query_function_id,
     target_function_id,
     args: NeighBSimLazyArgs,
-    session: m.Session,
+    session: "m.Session",
 ) -> NeighBSimResult:
     """A variation of our neighbsim implementation that fetches similarity lazily from the database.
     Much faster for querying few functions from a binary pair, but much slower for more functions.
+    See NeighBSimLazySession for scoring more functions lazily.
     """
 
     query_neighbors = list(
@@ -203,14 +351,17 @@ def neighbsim_lazy(
 
     # The coalesce here is not as bad as one might think.
     # As we only use functions from the ghidra call-graph (which ignores extern functions)
-    stmt = sa.text(f"""
+    stmt = sa.text("""
         SELECT qf.id, tf.id, COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0)
         FROM e."function:all" qf, e."function:all" tf
-        WHERE qf.id IN ({','.join(str(id) for id in query_neighbors)}) AND tf.id IN ({','.join(str(id) for id in target_neighbors)})
+        WHERE qf.id = ANY(:query_neighbors) AND tf.id = ANY(:target_neighbors)
     """)
 
     sg = nx.Graph()
-    for qf_id, tf_id, sim in session.execute(stmt):
+    for qf_id, tf_id, sim in session.execute(
+        stmt,
+        {"query_neighbors": query_neighbors, "target_neighbors": target_neighbors},
+    ):
         sg.add_edge(
             qf_id,
             tf_id,
@@ -228,3 +379,152 @@ def neighbsim_lazy(
             similarity_graph=sg,
         ),
     )
+
+
+class NeighBSimLazySession:
+    """Scores many function pairs of a binary pair with lazily fetched similarity.
+
+    Pairs are queued with add and scored with flush.
+    A flush fetches the similarity of all neighbour pairs that are not known yet in a
+    single statement. Fetched similarities are kept in a bounded LRU cache,
+    as function pairs of the same binary pair share most of their callers and callees.
+    """
+
+    def __init__(
+        self,
+        args: NeighBSimLazyArgs,
+        session: "m.Session",
+        cache_size: int = 2**20,
+    ):
+        self.args = args
+        self.session = session
+        #: The maximum amount of function pairs whose similarity is cached
+        self.cache_size = cache_size
+
+        #: Maps function pairs to their similarity.
+        #: None means that the database has no similarity for the pair.
+        self._similarity: collections.OrderedDict[tuple[int, int], float | None] = (
+            collections.OrderedDict()
+        )
+        self._queue: list[tuple[int, int]] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.round_trips = 0
+
+    def add(self, query_function_id: int, target_function_id: int):
+        self._queue.append((query_function_id, target_function_id))
+
+    def flush(self) -> list[NeighBSimResult | None]:
+        """Scores all queued pairs. Returns the results in the order the pairs were added.
+        Pairs that cannot be scored (e.g. because a function is not in its call-graph)
+        are logged and have None as result, the rest of the batch is scored anyway.
+        """
+        queue = self._queue
+        self._queue = []
+        if len(queue) == 0:
+            return []
+
+        pairs = self._neighbor_pairs(queue)
+
+        missing = []
+        for pair in pairs:
+            if pair in self._similarity:
+                self._similarity.move_to_end(pair)
+                pairs[pair] = self._similarity[pair]
+                self.hits += 1
+            else:
+                missing.append(pair)
+        self.misses += len(missing)
+
+        if len(missing) != 0:
+            fetched = self._fetch(missing)
+            for pair in missing:
+                pairs[pair] = fetched.get(pair)
+
+        # The batch gets its own graph, so evicting from the cache never affects scoring
+        sg = nx.Graph()
+        for (qf_id, tf_id), sim in pairs.items():
+            if sim is None:
+                continue
+            sg.add_edge(qf_id, tf_id, weight=sim)
+
+        for pair in missing:
+            self._similarity[pair] = pairs[pair]
+        while len(self._similarity) > self.cache_size:
+            self._similarity.popitem(last=False)
+
+        args = NeighBSimArgs(
+            query_binary_id=self.args.query_binary_id,
+            target_binary_id=self.args.target_binary_id,
+            query_call_graph=self.args.query_call_graph,
+            target_call_graph=self.args.target_call_graph,
+            similarity_graph=sg,
+        )
+        return [
+            _neighbsim_or_none(query_function_id, target_function_id, args)
+            for query_function_id, target_function_id in queue
+        ]
+
+    def neighbsim(self, query_function_id: int, target_function_id: int) -> NeighBSimResult | None:
+        """Scores a single pair (and all queued pairs). Returns None if it cannot be scored."""
+        self.add(query_function_id, target_function_id)
+        return self.flush()[-1]
+
+    def _neighbor_pairs(self, queue: list[tuple[int, int]]) -> dict[tuple[int, int], None]:
+        """Returns the neighbour pairs of all queued pairs (as keys, to keep their order)."""
+        pairs = {}
+        for query_function_id, target_function_id in queue:
+            try:
+                neighbor_pairs = itertools.product(
+                    _neighbors(self.args.query_call_graph, query_function_id),
+                    _neighbors(self.args.target_call_graph, target_function_id),
+                )
+            except nx.NetworkXError:
+                # The pair is logged when it is scored, see _neighbsim_or_none
+                continue
+            pairs.update(dict.fromkeys(neighbor_pairs))
+
+        return pairs
+
+    def _fetch(self, pairs: list[tuple[int, int]]) -> dict[tuple[int, int], float]:
+        # See neighbsim_lazy for the coalesce
+        stmt = sa.text(
+            """
+            SELECT p.qf_id, p.tf_id, COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0)
+            FROM unnest(CAST(:qf_ids AS bigint[]), CAST(:tf_ids AS bigint[])) AS p(qf_id, tf_id)
+                JOIN e."function:all" qf ON (qf.id = p.qf_id)
+                JOIN e."function:all" tf ON (tf.id = p.tf_id)
+            """
+        )
+        qf_ids, tf_ids = zip(*pairs)
+        self.round_trips += 1
+
+        return {
+            (qf_id, tf_id): sim
+            for qf_id, tf_id, sim in self.session.execute(
+                stmt,
+                {"qf_ids": list(qf_ids), "tf_ids": list(tf_ids)},
+            )
+        }
+
+
+def _neighbsim_or_none(
+    query_function_id: int,
+    target_function_id: int,
+    args: NeighBSimArgs,
+) -> NeighBSimResult | None:
+    try:
+        return neighbsim(query_function_id, target_function_id, args)
+    except nx.NetworkXError as e:
+        logging.warning(f"Could not score ({query_function_id}, {target_function_id}): {e}")
+        return None
+
+
+def _neighbors(call_graph: nx.DiGraph, function_id: int) -> set[int]:
+    """Returns the callers and callees of the function and the function itself."""
+    ret = set(call_graph.predecessors(function_id))
+    ret.update(call_graph.successors(function_id))
+    ret.add(function_id)
+
+    return ret
@@ -0,0 +1,604 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""Builds the figures of approach-evaluation.ipynb.
+
+Statistics (ROC curves and AUCs per dataset, score and stratum) are computed once and
+cached together with a fingerprint of the dataset files they were computed from.
+Figures are rendered in a process pool and only if their inputs changed since the last build.
+"""
+
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import pathlib as pl
+import pickle
+
+import msgspec
+import numpy as np
+import pandas as pd
+import sklearn.metrics
+
+from evaluatie.data import BINS, DatasetOptions, DatasetRegistry
+
+#: Bump this whenever the rendering code changes, to render all figures again.
+RENDER_VERSION = 1
+
+SCORE_LABELS = {
+    "bsim": "BSim",
+    "neighbsim": "NeighBSim",
+}
+
+#: Labels of the datasets. Overview datasets (e.g. f:o0Xo2-overview) share the label of their dataset.
+DATASET_LABELS = {
+    "f:x86Xarm": "x86 vs. arm",
+    "f:x86Xmips": "x86 vs. mips",
+    "f:armXmips": "arm vs. mips",
+    "f:o0Xo2": "O0 vs. O2",
+    "f:o0Xo3": "O0 vs. O3",
+    "f:osXo0": "Os vs. O0",
+    "f:osXo2": "Os vs. O2",
+    "f:osXo3": "Os vs. O3",
+    "f:noinlineXinline": "noinline vs. inline",
+    "f:noltoXlto": "LTO",
+    "f:nopieXpie": "PIE",
+    "f:random": "Random",
+}
+
+
+def dataset_label(name: str) -> str:
+    return DATASET_LABELS.get(name.removesuffix("-overview"), name)
+
+
+class StatisticsCache:
+    """A persistent cache of statistics.
+    Every entry is stored with the fingerprint of its inputs and is recomputed when
+    the fingerprint changes.
+    """
+
+    def __init__(self, path: pl.Path):
+        self.path = pl.Path(path)
+        self._key2entry: dict[tuple, tuple[str, object]] = {}
+        if self.path.exists():
+            with self.path.open("rb") as f:
+                self._key2entry = pickle.load(f)
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, fingerprint: str, compute):
+        entry = self._key2entry.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = compute()
+        self._key2entry[key] = (fingerprint, value)
+        return value
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp_path.open("wb") as f:
+            pickle.dump(self._key2entry, f)
+        tmp_path.replace(self.path)
+
+
+class ScoreDistributionFigure(msgspec.Struct, frozen=True):
+    """The score distribution of positives and negatives for every stratum of a dataset."""
+
+    name: str
+    score_col: str
+
+    @property
+    def path(self) -> str:
+        return f"score-dist/{self.name}-{self.score_col}.pdf"
+
+    @property
+    def datasets(self) -> list[str]:
+        return [self.name]
+
+    def payload(self, builder: "ReportBuilder"):
+        return builder.frame(self.name)[["label", self.score_col, "qsize", "qneighborhood_size"]]
+
+    def render(self, frame: pd.DataFrame, path: pl.Path):
+        from matplotlib import pyplot as plt
+
+        fig, axs = plt.subplots(
+            nrows=3,
+            ncols=3,
+            # Turned off to set labels for each axis individually
+            sharex=False,
+            sharey=True,
+        )
+
+        for row, col_axs in enumerate(axs):
+            for col, ax in enumerate(col_axs):
+                options = DatasetOptions(
+                    size=BINS[col],
+                    neighborhood_size=BINS[row],
+                )
+                _plot_kde(frame.loc[options.indexer(frame)], self.score_col, ax)
+
+                ax.set_xticklabels([])
+                ax.set_xlabel("Score")
+                ax.set_ylabel("Density")
+
+                ax.yaxis.set_label_position("right")
+                # Needed to make the label show up on the rightmost plot, not on the leftmost
+                ax.yaxis.tick_right()
+                ax.tick_params(axis="y", labelright=True)
+
+        for ax in axs.flatten():
+            ax.label_outer()
+
+        for row, col in itertools.product(range(3), range(3)):
+            if (row, col) == (0, 2):
+                continue
+            legend = axs[row][col].get_legend()
+            if legend is not None:
+                legend.remove()
+        if axs[0][2].get_legend() is not None:
+            axs[0][2].get_legend().set_title("Label")
+
+        for idx, label in enumerate(["Low", "Medium", "High"]):
+            axs[0][idx].set_title(label, loc="center")
+            axs[idx][0].set_title(
+                label,
+                loc="left",
+                y=0.5,
+                rotation="vertical",
+                va="center",
+                x=-0.15,
+            )
+
+        xticks = [0, 0.5, 1]
+        for ax in axs[2]:
+            ax.set_xticks(xticks)
+        axs[2][0].set_xticklabels([0.0, 0.5, 1.0])
+        axs[2][1].set_xticklabels(["", 0.5, ""])
+        axs[2][2].set_xticklabels([0.0, 0.5, 1.0])
+
+        axs[0][0].set_yticks([0, 10, 20])
+        axs[0][0].set_yticklabels([0, 10, ""])
+        axs[0][0].set_ylim(0, 20)
+
+        fig.subplots_adjust(
+            wspace=0,
+            hspace=0,
+        )
+        fig.suptitle("#BasicBlocks")
+        fig.supylabel("#Neighbors", x=0.03)
+
+        fig.savefig(path)
+        plt.close(fig)
+
+
+class HeatmapFigure(msgspec.Struct, frozen=True):
+    """The AUC of every stratum of several datasets as heatmaps."""
+
+    path: str
+    names: list[str]
+    score_col: str
+
+    @property
+    def datasets(self) -> list[str]:
+        return self.names
+
+    def payload(self, builder: "ReportBuilder"):
+        return [
+            (dataset_label(name), builder.auc_table(name, self.score_col, all=False))
+            for name in self.names
+        ]
+
+    def render(self, label_tables: list[tuple[str, pd.DataFrame]], path: pl.Path):
+        import matplotlib.image
+        from matplotlib import pyplot as plt
+
+        size_per_dataset = 3
+        fig, axs = plt.subplots(
+            nrows=1,
+            ncols=len(label_tables),
+            sharey=True,
+            figsize=(size_per_dataset * len(label_tables), 3),
+            squeeze=False,
+        )
+        axs = axs[0]
+
+        for (label, tbl), ax in zip(label_tables, axs):
+            _setup_heatmap_axis(ax)
+            ax.imshow(
+                tbl.to_numpy(),
+                cmap="YlGn",
+                vmin=0.9,
+                vmax=1.0,
+            )
+            for i in range(len(tbl.columns)):
+                for j in range(len(tbl)):
+                    ax.text(
+                        i,
+                        j,
+                        _format_auc(tbl.iloc[j, i]),
+                        ha="center",
+                        va="center",
+                        color="black",
+                    )
+            ax.set_title(label, y=0, pad=-20)
+
+        for ax in axs[1:]:
+            ax.tick_params(
+                axis="y",
+                left=False,
+                labelleft=False,
+                which="major",
+            )
+            ax.set_ylabel(None)
+
+        images = [
+            child for child in axs[0].get_children() if isinstance(child, matplotlib.image.AxesImage)
+        ]
+        fig.colorbar(images[0], ax=axs)
+
+        fig.savefig(path, bbox_inches="tight", transparent=True)
+        plt.close(fig)
+
+
+class BarChartFigure(msgspec.Struct, frozen=True):
+    """The AUC of BSim and NeighBSim of several datasets."""
+
+    path: str
+    names: list[str]
+
+    @property
+    def datasets(self) -> list[str]:
+        return self.names
+
+    def payload(self, builder: "ReportBuilder"):
+        return pd.DataFrame(
+            {
+                score_col: [builder.auc(name, score_col) for name in self.names]
+                for score_col in ["bsim", "neighbsim"]
+            },
+            index=[dataset_label(name) for name in self.names],
+        )
+
+    def render(self, aucs: pd.DataFrame, path: pl.Path):
+        from matplotlib import pyplot as plt
+
+        fig, ax = plt.subplots(figsize=(12, 4))
+
+        width = 0.35
+        x = np.arange(len(aucs))
+        for offset, score_col, color in [(0, "bsim", "green"), (width, "neighbsim", "tomato")]:
+            rects = ax.bar(
+                x=x + offset,
+                height=aucs[score_col],
+                label=SCORE_LABELS[score_col],
+                width=width,
+                color=color,
+            )
+            ax.bar_label(
+                rects,
+                padding=3,
+                fmt=_format_auc,
+                rotation=0,
+                fontsize="x-small",
+            )
+
+        ax.set_ylim((0.9, 1.0))
+        ax.set_ylabel("AUC")
+        ax.legend(loc="lower left")
+        ax.set_yticks(np.arange(0.90, 1.01, 0.01))
+        ax.set_xticks(
+            x + 0.5 * width,
+            labels=aucs.index,
+            rotation=60,
+            fontsize="medium",
+        )
+        ax.grid(color="grey", linewidth=0.4, axis="y")
+
+        fig.savefig(path, bbox_inches="tight", transparent=True)
+        plt.close(fig)
+
+
+class RocFigure(msgspec.Struct, frozen=True):
+    """ROC curves of several datasets and scores."""
+
+    path: str
+    #: Tuples of dataset name, score column and label of the curve
+    curves: list[tuple[str, str, str]]
+
+    @property
+    def datasets(self) -> list[str]:
+        return sorted({name for name, _, _ in self.curves})
+
+    def payload(self, builder: "ReportBuilder"):
+        return [(*builder.roc(name, score_col), label) for name, score_col, label in self.curves]
+
+    def render(self, curves: list[tuple[np.ndarray, np.ndarray, str]], path: pl.Path):
+        from matplotlib import pyplot as plt
+
+        fig, ax = plt.subplots()
+        for fpr, tpr, label in curves:
+            ax.plot(
+                fpr,
+                tpr,
+                drawstyle="steps-post",
+                clip_on=False,
+                label=label,
+            )
+        ax.plot([0, 1], [0, 1], "--", color="gray", label="Random")
+
+        ax.set_xlabel("False-Positive Rate")
+        ax.set_ylabel("True-Positive Rate")
+        ax.set_aspect("equal")
+        ax.set_xlim(xmin=0, xmax=1)
+        ax.set_ylim(ymin=0, ymax=1)
+        ax.legend()
+
+        fig.savefig(path, bbox_inches="tight", transparent=True)
+        plt.close(fig)
+
+
+Figure = ScoreDistributionFigure | HeatmapFigure | BarChartFigure | RocFigure
+
+
+class ReportBuildResult(msgspec.Struct, frozen=True):
+    rendered: list[str]
+    #: Figures whose inputs did not change since the last build
+    skipped: list[str]
+    cache_hits: int
+    cache_misses: int
+
+
+class ReportBuilder:
+    """Renders figures into figures_dir.
+    The statistics cache and the fingerprints of the rendered figures are stored in figures_dir.
+    """
+
+    def __init__(
+        self,
+        figures_dir: pl.Path = pl.Path("figures"),
+        registry: DatasetRegistry | None = None,
+        max_workers: int | None = None,
+    ):
+        self.figures_dir = pl.Path(figures_dir)
+        self.registry = registry if registry is not None else DatasetRegistry()
+        self.max_workers = max_workers
+        self.cache = StatisticsCache(self.figures_dir / ".statistics.pickle")
+
+        self._manifest_path = self.figures_dir / ".figures.json"
+        self._name2fingerprint: dict[str, str] = {}
+
+    def dataset_fingerprint(self, name: str) -> str:
+        """Fingerprints the files of the dataset, so the dataset is not loaded to find out
+        that it did not change.
+        """
+        if name not in self._name2fingerprint:
+            h = hashlib.sha256(name.encode())
+            for path in [pl.Path("datasets", f"{name}.csv"), pl.Path("datasets", f"{name}.pickle.gz")]:
+                stat = path.stat()
+                h.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+            self._name2fingerprint[name] = h.hexdigest()
+
+        return self._name2fingerprint[name]
+
+    def frame(self, name: str) -> pd.DataFrame:
+        return self.registry.get(name).frame
+
+    def roc(
+        self,
+        name: str,
+        score_col: str,
+        size: str = "all",
+        neighborhood_size: str = "all",
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the false-positive rates and true-positive rates of the stratum."""
+
+        def compute():
+            frame = self.frame(name)
+            options = DatasetOptions(size=size, neighborhood_size=neighborhood_size)
+            frame = frame[options.indexer(frame)]
+            fpr, tpr, _ = sklearn.metrics.roc_curve(
+                y_true=frame["label"],
+                y_score=frame[score_col],
+            )
+            return fpr, tpr
+
+        return self.cache.get(
+            ("roc", name, score_col, size, neighborhood_size),
+            self.dataset_fingerprint(name),
+            compute,
+        )
+
+    def auc(
+        self,
+        name: str,
+        score_col: str,
+        size: str = "all",
+        neighborhood_size: str = "all",
+    ) -> float:
+        return self.cache.get(
+            ("auc", name, score_col, size, neighborhood_size),
+            self.dataset_fingerprint(name),
+            lambda: float(sklearn.metrics.auc(*self.roc(name, score_col, size, neighborhood_size))),
+        )
+
+    def auc_table(self, name: str, score_col: str, all: bool = True) -> pd.DataFrame:
+        """The AUC of every stratum, see create_table in approach-evaluation.ipynb."""
+        categories = list(BINS)
+        if all:
+            categories.append("all")
+
+        tbl = pd.DataFrame(
+            index=pd.Index(categories, name="neighborhood_size"),
+            columns=pd.Index(categories, name="size"),
+            dtype=np.float64,
+        )
+        for size, neighborhood_size in itertools.product(categories, categories):
+            tbl.loc[neighborhood_size, size] = self.auc(name, score_col, size, neighborhood_size)
+
+        return tbl
+
+    def build(self, figures: list[Figure], force: bool = False) -> ReportBuildResult:
+        """Renders every figure whose inputs changed since the last build
+        (or all figures if force is set).
+        """
+        path2fingerprint = {}
+        if self._manifest_path.exists():
+            path2fingerprint = msgspec.json.decode(
+                self._manifest_path.read_bytes(),
+                type=dict[str, str],
+            )
+
+        stale = []
+        skipped = []
+        for figure in figures:
+            fingerprint = self._figure_fingerprint(figure)
+            path = self.figures_dir / figure.path
+            if not force and path.exists() and path2fingerprint.get(figure.path) == fingerprint:
+                skipped.append(figure.path)
+                continue
+            stale.append((figure, fingerprint))
+
+        rendered = []
+        if len(stale) != 0:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_worker,
+            ) as executor:
+                future2figure = {}
+                for figure, fingerprint in stale:
+                    path = self.figures_dir / figure.path
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    # Payloads are computed here, so statistics are computed once and cached
+                    future = executor.submit(_render, figure, figure.payload(self), path)
+                    future2figure[future] = (figure, fingerprint)
+
+                for future in concurrent.futures.as_completed(future2figure):
+                    figure, fingerprint = future2figure[future]
+                    future.result()
+                    path2fingerprint[figure.path] = fingerprint
+                    rendered.append(figure.path)
+
+        self.cache.save()
+        self.figures_dir.mkdir(parents=True, exist_ok=True)
+        self._manifest_path.write_bytes(msgspec.json.encode(path2fingerprint))
+
+        return ReportBuildResult(
+            rendered=sorted(rendered),
+            skipped=skipped,
+            cache_hits=self.cache.hits,
+            cache_misses=self.cache.misses,
+        )
+
+    def _figure_fingerprint(self, figure: Figure) -> str:
+        h = hashlib.sha256()
+        h.update(f"{RENDER_VERSION}:{type(figure).__name__}:".encode())
+        h.update(msgspec.json.encode(figure))
+        for name in figure.datasets:
+            h.update(self.dataset_fingerprint(name).encode())
+
+        return h.hexdigest()
+
+
+def default_figures() -> list[Figure]:
+    """The figures of approach-evaluation.ipynb."""
+    optimization = ["f:o0Xo2", "f:o0Xo3", "f:osXo0", "f:osXo2", "f:osXo3"]
+    architecture = ["f:x86Xarm", "f:x86Xmips", "f:armXmips"]
+    misc = ["f:noinlineXinline", "f:noltoXlto", "f:nopieXpie", "f:random"]
+
+    figures = [
+        ScoreDistributionFigure(name=name, score_col=score_col)
+        for name in [*optimization, "f:armXmips", "f:x86Xarm", "f:x86Xmips", *misc]
+        for score_col in ["bsim", "neighbsim"]
+    ]
+    for group, names in [
+        ("optimization", optimization),
+        ("architecture", architecture),
+        ("misc", misc),
+    ]:
+        for score_col in ["neighbsim", "bsim"]:
+            figures.append(
+                HeatmapFigure(
+                    path=f"heatmap-{group}-{score_col}.pdf",
+                    names=names,
+                    score_col=score_col,
+                )
+            )
+    figures.append(
+        BarChartFigure(
+            path="evaluation:neighbsim-vs-bsim-barchart.pdf",
+            names=[f"{name}-overview" for name in [*optimization, *architecture, *misc]],
+        )
+    )
+    figures.append(
+        RocFigure(
+            path="roc.pdf",
+            curves=[
+                ("f:armXmips", "neighbsim", "ARM vs. MIPS (NeighBSim)"),
+                ("f:o0Xo3", "bsim", "O0 vs. O3 (BSim)"),
+            ],
+        )
+    )
+
+    return figures
+
+
+def _init_worker():
+    import matplotlib as mpl
+
+    mpl.use("Agg")
+    mpl.rc("font", size=12)
+
+
+def _render(figure: Figure, payload, path: pl.Path):
+    # Write to a temporary file first, so an interrupted build never leaves a broken figure
+    tmp_path = path.with_name(f".{os.getpid()}-{path.name}")
+    figure.render(payload, tmp_path)
+    tmp_path.replace(path)
+
+
+def _plot_kde(frame: pd.DataFrame, score_col: str, ax):
+    import seaborn as sns
+
+    plot_df = frame.assign(label=frame["label"].map({True: "Positive", False: "Negative"}))
+    sns.kdeplot(
+        data=plot_df,
+        x=score_col,
+        hue="label",
+        cut=0,
+        clip=(0, 1),
+        fill=True,
+        common_norm=False,
+        ax=ax,
+    )
+
+    ax.set_xlim(0, 1)
+    ax.set_xlabel(SCORE_LABELS[score_col])
+
+
+def _setup_heatmap_axis(ax):
+    ax.xaxis.tick_top()
+    ax.xaxis.set_label_position("top")
+
+    labels = ["Low", "Medium", "High"]
+    ax.set_xticks(ticks=np.arange(len(labels)), labels=labels)
+    ax.set_yticks(ticks=np.arange(len(labels)), labels=labels)
+    ax.set_aspect("equal")
+
+    ax.set_xticks(np.arange(len(labels)) - 0.5, minor=True)
+    ax.set_yticks(np.arange(len(labels)) - 0.5, minor=True)
+    ax.grid(visible=True, color="black", which="minor")
+    ax.tick_params(which="minor", bottom=False, left=False, top=False, right=False)
+
+    ax.set_xlabel("#BasicBlocks")
+    ax.set_ylabel("#Neighbors")
+
+
+def _format_auc(value: float) -> str:
+    return f"{value:.3f}".lstrip("0")
@@ -0,0 +1,282 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import functools
+import logging
+import pathlib as pl
+import typing
+
+import msgspec
+import networkx as nx
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from evaluatie import utils
+from evaluatie.data import FunctionDataset
+from evaluatie.neighbsim.components import COMPONENT_COLUMNS, COMPONENT_DTYPES
+from evaluatie.neighbsim.matching import ALGORITHMS, MatchingMemo, MatchingOptions
+from evaluatie.neighbsim.neighbsim import NeighBSimArgs, NeighBSimResult, neighbsim
+
+if typing.TYPE_CHECKING:
+    from evaluatie import models as m
+
+#: Columns that identify a row that has to be scored.
+KEY_COLUMNS = [
+    "query_binary_id",
+    "target_binary_id",
+    "query_function_id",
+    "target_function_id",
+]
+
+#: Columns that scoring adds to a dataset. These are stored in the dataset's pickle.
+RESULT_COLUMNS = [
+    "neighbsim",
+    "caller_matching",
+    "callee_matching",
+    "qcallers",
+    "tcallers",
+    "qcallees",
+    "tcallees",
+    *COMPONENT_COLUMNS,
+    # The matching algorithms and how much higher the score could be with exact matchings
+    "caller_matching_algorithm",
+    "callee_matching_algorithm",
+    "score_error_bound",
+]
+
+RESULT_DTYPES = {
+    "neighbsim": np.float64,
+    **COMPONENT_DTYPES,
+    "caller_matching_algorithm": pd.CategoricalDtype(ALGORITHMS),
+    "callee_matching_algorithm": pd.CategoricalDtype(ALGORITHMS),
+    "score_error_bound": np.float64,
+}
+
+
+class DatabaseSource:
+    """Loads call-graphs and similarities from the evaluatie database.
+    Call-graphs are cached, as the same binary is part of many binary pairs.
+    """
+
+    def __init__(self, session: "m.Session", call_graph_cache_size: int = 64):
+        self.session = session
+        self.call_graph = functools.lru_cache(maxsize=call_graph_cache_size)(self._call_graph)
+
+    def _call_graph(self, binary_id: int) -> nx.DiGraph:
+        return utils.call_graph_from_binary_id(binary_id, self.session)
+
+    def similarity_graph(
+        self,
+        qb_id: int,
+        tb_id: int,
+        query_function_ids: list[int],
+        target_function_ids: list[int],
+    ) -> nx.Graph:
+        _ = qb_id, tb_id
+        return utils.similarity_graph_from_function_ids(
+            query_function_ids,
+            target_function_ids,
+            self.session,
+        )
+
+
+class ScoringPlanReport(msgspec.Struct, frozen=True):
+    dataset_count: int
+    #: Sum of the binary pairs of all datasets
+    binary_pair_count: int
+    distinct_binary_pair_count: int
+    #: Sum of the rows of all datasets
+    row_count: int
+    distinct_row_count: int
+
+    @property
+    def saved_binary_pair_count(self) -> int:
+        return self.binary_pair_count - self.distinct_binary_pair_count
+
+    @property
+    def saved_row_count(self) -> int:
+        return self.row_count - self.distinct_row_count
+
+    def __str__(self) -> str:
+        return (
+            f"{self.dataset_count} datasets:"
+            f" {self.distinct_binary_pair_count} of {self.binary_pair_count} binary pairs"
+            f" and {self.distinct_row_count} of {self.row_count} rows are distinct"
+            f" ({self.saved_binary_pair_count} binary pairs and {self.saved_row_count} rows saved)"
+        )
+
+
+class ScoringPlan(msgspec.Struct):
+    """The distinct work needed to score several datasets at once."""
+
+    #: The distinct rows of all datasets, see KEY_COLUMNS.
+    rows: pd.DataFrame
+    #: Maps a dataset name to a series that maps the dataset's index to a position in rows.
+    name2positions: dict[str, pd.Series]
+    report: ScoringPlanReport
+
+
+def plan_datasets(names: list[str]) -> ScoringPlan:
+    """Computes the union of binary pairs and function pairs of the named datasets."""
+    return plan_frames(
+        {name: FunctionDataset.from_name(name).frame[KEY_COLUMNS] for name in names}
+    )
+
+
+def plan_frames(name2frame: dict[str, pd.DataFrame]) -> ScoringPlan:
+    """Like plan_datasets, but for already loaded dataset frames."""
+    frames = []
+    binary_pair_count = 0
+    for name, frame in name2frame.items():
+        keys = frame[KEY_COLUMNS]
+        binary_pair_count += len(keys[KEY_COLUMNS[:2]].drop_duplicates())
+        frames.append(keys.assign(dataset=name, dataset_index=keys.index))
+
+    all_rows = pd.concat(frames, ignore_index=True)
+    rows = all_rows[KEY_COLUMNS].drop_duplicates(ignore_index=True)
+    positions = all_rows.merge(
+        rows.reset_index(names="position"),
+        on=KEY_COLUMNS,
+        how="left",
+    )
+
+    name2positions = {
+        name: group.set_index("dataset_index")["position"].rename_axis(None)
+        for name, group in positions.groupby("dataset", sort=False)
+    }
+
+    report = ScoringPlanReport(
+        dataset_count=len(name2frame),
+        binary_pair_count=binary_pair_count,
+        distinct_binary_pair_count=len(rows[KEY_COLUMNS[:2]].drop_duplicates()),
+        row_count=len(all_rows),
+        distinct_row_count=len(rows),
+    )
+
+    return ScoringPlan(
+        rows=rows,
+        name2positions=name2positions,
+        report=report,
+    )
+
+
+def execute_plan(
+    plan: ScoringPlan,
+    source,
+    matching: MatchingOptions = MatchingOptions(),
+    memo: MatchingMemo | None = None,
+) -> dict[str, pd.DataFrame]:
+    """Scores every distinct row of the plan exactly once.
+    Returns a frame with RESULT_COLUMNS for every dataset of the plan,
+    indexed like the dataset's frame.
+    Matchings are memoized within each binary pair, pass a memo to inspect its stats.
+    """
+    if memo is None:
+        memo = MatchingMemo()
+
+    position2row = {}
+    groups = plan.rows.groupby(KEY_COLUMNS[:2], sort=True)
+    for (qb_id, tb_id), group in tqdm(groups, total=groups.ngroups):
+        args = neighbsim_args_for_rows(int(qb_id), int(tb_id), group, source)
+        for position, qf_id, tf_id in zip(
+            group.index,
+            group["query_function_id"].tolist(),
+            group["target_function_id"].tolist(),
+        ):
+            try:
+                result = neighbsim(qf_id, tf_id, args, matching=matching, memo=memo)
+            except nx.NetworkXError as e:
+                logging.warning(f"Could not score ({qf_id}, {tf_id}): {e}")
+                continue
+            position2row[position] = _row_from_result(result)
+
+    results = pd.DataFrame.from_dict(
+        position2row,
+        orient="index",
+        columns=RESULT_COLUMNS,
+    ).reindex(plan.rows.index)
+    results = results.astype(RESULT_DTYPES)
+    logging.info(str(memo.stats()))
+
+    return {
+        name: results.loc[positions.to_numpy()].set_axis(positions.index)
+        for name, positions in plan.name2positions.items()
+    }
+
+
+def write_results(name2results: dict[str, pd.DataFrame], directory: pl.Path = pl.Path("datasets")):
+    """Writes the results to the pickles that FunctionDataset.load_pickle reads."""
+    for name, results in name2results.items():
+        results.to_pickle(pl.Path(directory, f"{name}.pickle.gz"))
+
+
+def score_datasets(
+    names: list[str],
+    session: "m.Session",
+    matching: MatchingOptions = MatchingOptions(),
+) -> ScoringPlanReport:
+    """Scores all named datasets, sharing work between datasets that have rows in common."""
+    plan = plan_datasets(names)
+    logging.info(str(plan.report))
+
+    name2results = execute_plan(plan, DatabaseSource(session), matching=matching)
+    write_results(name2results)
+
+    return plan.report
+
+
+def neighbsim_args_for_rows(qb_id: int, tb_id: int, rows: pd.DataFrame, source) -> NeighBSimArgs:
+    """Fetches the similarity of all functions that scoring the rows can touch,
+    i.e. the query and target functions and their neighbours.
+    """
+    qcg = source.call_graph(qb_id)
+    tcg = source.call_graph(tb_id)
+
+    return NeighBSimArgs(
+        query_binary_id=qb_id,
+        target_binary_id=tb_id,
+        query_call_graph=qcg,
+        target_call_graph=tcg,
+        similarity_graph=source.similarity_graph(
+            qb_id,
+            tb_id,
+            _with_neighbors(rows["query_function_id"].unique().tolist(), qcg),
+            _with_neighbors(rows["target_function_id"].unique().tolist(), tcg),
+        ),
+    )
+
+
+def _with_neighbors(function_ids, call_graph: nx.DiGraph) -> list[int]:
+    ret = set(function_ids)
+    for function_id in function_ids:
+        if function_id not in call_graph:
+            continue
+        ret.update(call_graph.predecessors(function_id))
+        ret.update(call_graph.successors(function_id))
+
+    return sorted(ret)
+
+
+def _row_from_result(result: NeighBSimResult) -> list:
+    return [
+        result.score,
+        result.caller_matching,
+        result.callee_matching,
+        result.qcallers,
+        result.tcallers,
+        result.qcallees,
+        result.tcallees,
+        result.bsim,
+        result.caller_sum,
+        result.callee_sum,
+        len(result.qcallers),
+        len(result.tcallers),
+        len(result.qcallees),
+        len(result.tcallees),
+        result.caller_matching_algorithm,
+        result.callee_matching_algorithm,
+        result.score_error_bound,
+    ]
@@ -0,0 +1,531 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""A local scoring service that keeps call-graphs and similarity graphs in memory.
+
+The service listens on a unix socket. Every message is a msgpack encoded request or
+response, prefixed by its length as a 4 byte big endian integer.
+A connection can send any number of requests; each is answered before the next is read.
+Connections are handled concurrently.
+See ServiceClient for the client side.
+"""
+
+import collections
+import concurrent.futures
+import errno
+import logging
+import os
+import pathlib as pl
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import typing
+
+import msgspec
+import networkx as nx
+import numpy as np
+
+from evaluatie import utils
+from evaluatie.firmup.firmup import FirmUPArgs, StepLimitReachedError, firmup
+from evaluatie.neighbsim.matching import MatchingOptions
+from evaluatie.neighbsim.neighbsim import NeighBSimArgs, neighbsim, neighbsim_topk
+
+DEFAULT_SOCKET_PATH = pl.Path(
+    os.getenv(
+        "EVALUATIE_SOCKET_PATH",
+        pl.Path(tempfile.gettempdir(), f"evaluatie-{os.getuid()}.sock"),
+    )
+)
+
+_LENGTH = struct.Struct(">I")
+#: Latencies of the most recent requests of each kind that the percentiles are computed from
+_LATENCY_WINDOW = 4096
+
+
+class NeighBSimRequest(msgspec.Struct, frozen=True, tag="neighbsim"):
+    query_binary_id: int
+    target_binary_id: int
+    query_function_id: int
+    target_function_id: int
+    #: See matching.MatchingOptions
+    matching: str = "exact"
+
+
+class FirmUPRequest(msgspec.Struct, frozen=True, tag="firmup"):
+    query_binary_id: int
+    target_binary_id: int
+    query_function_id: int
+    max_steps: int | None = None
+
+
+class TopKRequest(msgspec.Struct, frozen=True, tag="topk"):
+    query_binary_id: int
+    target_binary_id: int
+    query_function_id: int
+    k: int
+
+
+class StatsRequest(msgspec.Struct, frozen=True, tag="stats"):
+    pass
+
+
+Request = NeighBSimRequest | FirmUPRequest | TopKRequest | StatsRequest
+
+
+class NeighBSimResponse(msgspec.Struct, frozen=True, tag="neighbsim"):
+    score: float
+    bsim: float
+    #: Matched pairs as (query function, target function, similarity)
+    caller_matching: list[tuple[int, int, float]]
+    callee_matching: list[tuple[int, int, float]]
+    caller_matching_algorithm: str
+    callee_matching_algorithm: str
+    score_error_bound: float
+
+
+class FirmUPResponse(msgspec.Struct, frozen=True, tag="firmup"):
+    #: None if the game failed or the step limit was reached
+    match_function_id: int | None
+    steps: int | None
+    step_limit_reached: bool
+
+
+class TopKResponse(msgspec.Struct, frozen=True, tag="topk"):
+    target_function_ids: list[int]
+    scores: list[float]
+    candidate_count: int
+    scored_count: int
+
+
+class CacheStats(msgspec.Struct, frozen=True):
+    size: int
+    capacity: int
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class LatencyStats(msgspec.Struct, frozen=True):
+    count: int
+    #: In seconds, over the most recent requests
+    mean: float
+    p50: float
+    p99: float
+    max: float
+
+
+class StatsResponse(msgspec.Struct, frozen=True, tag="stats"):
+    call_graphs: CacheStats
+    similarity_graphs: CacheStats
+    #: Maps the request tags to their latencies
+    latencies: dict[str, LatencyStats]
+
+
+class ErrorResponse(msgspec.Struct, frozen=True, tag="error"):
+    message: str
+
+
+Response = NeighBSimResponse | FirmUPResponse | TopKResponse | StatsResponse | ErrorResponse
+
+
+class ServiceError(Exception):
+    """The service could not answer a request."""
+
+
+class _LruCache:
+    """A thread-safe LRU cache that loads every key only once, even if it is requested
+    by several threads at the same time.
+    """
+
+    def __init__(self, capacity: int, load: typing.Callable):
+        self.capacity = capacity
+        self._load = load
+        self._lock = threading.Lock()
+        self._key2value: collections.OrderedDict = collections.OrderedDict()
+        self._key2future: dict[object, concurrent.futures.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._key2value:
+                self._key2value.move_to_end(key)
+                self.hits += 1
+                return self._key2value[key]
+
+            self.misses += 1
+            future = self._key2future.get(key)
+            loading = future is None
+            if loading:
+                future = concurrent.futures.Future()
+                self._key2future[key] = future
+
+        if not loading:
+            return future.result()
+
+        try:
+            value = self._load(*key)
+        except BaseException as e:
+            with self._lock:
+                del self._key2future[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._key2future[key]
+            self._key2value[key] = value
+            while len(self._key2value) > self.capacity:
+                self._key2value.popitem(last=False)
+        future.set_result(value)
+
+        return value
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                size=len(self._key2value),
+                capacity=self.capacity,
+                hits=self.hits,
+                misses=self.misses,
+            )
+
+
+class DatabaseLoader:
+    """Loads call-graphs and the similarity graphs of binary pairs from the database.
+    Every load uses its own session, as sessions must not be shared between threads.
+    """
+
+    def __init__(self, sessionmaker=None):
+        if sessionmaker is None:
+            from evaluatie import models as m
+
+            sessionmaker = m.Session
+        self.sessionmaker = sessionmaker
+
+    def call_graph(self, binary_id: int) -> nx.DiGraph:
+        with self.sessionmaker() as session:
+            return utils.call_graph_from_binary_id(binary_id, session)
+
+    def similarity_graph(self, qb_id: int, tb_id: int) -> nx.Graph:
+        with self.sessionmaker() as session:
+            return utils.similarity_graph_from_pair(qb_id, tb_id, session)
+
+
+class ScoringService:
+    """Answers requests from call-graphs and similarity graphs that are kept in LRU caches."""
+
+    def __init__(
+        self,
+        loader=None,
+        call_graph_cache_size: int = 256,
+        similarity_graph_cache_size: int = 32,
+    ):
+        if loader is None:
+            loader = DatabaseLoader()
+        self.call_graphs = _LruCache(call_graph_cache_size, loader.call_graph)
+        self.similarity_graphs = _LruCache(similarity_graph_cache_size, loader.similarity_graph)
+
+        self._latency_lock = threading.Lock()
+        self._tag2latencies: dict[str, collections.deque[float]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=_LATENCY_WINDOW)
+        )
+        self._tag2count: collections.Counter[str] = collections.Counter()
+
+    def handle(self, request: Request) -> Response:
+        start = time.perf_counter()
+        try:
+            response = self._handle(request)
+        except Exception as e:
+            logging.exception(f"Could not answer {request}")
+            response = ErrorResponse(message=f"{type(e).__name__}: {e}")
+
+        tag = type(request).__struct_config__.tag
+        with self._latency_lock:
+            self._tag2latencies[tag].append(time.perf_counter() - start)
+            self._tag2count[tag] += 1
+
+        return response
+
+    def stats(self) -> StatsResponse:
+        with self._latency_lock:
+            latencies = {
+                tag: _latency_stats(self._tag2count[tag], np.array(window))
+                for tag, window in self._tag2latencies.items()
+            }
+
+        return StatsResponse(
+            call_graphs=self.call_graphs.stats(),
+            similarity_graphs=self.similarity_graphs.stats(),
+            latencies=latencies,
+        )
+
+    def neighbsim_args(self, qb_id: int, tb_id: int) -> NeighBSimArgs:
+        return NeighBSimArgs(
+            query_binary_id=qb_id,
+            target_binary_id=tb_id,
+            query_call_graph=self.call_graphs.get((qb_id,)),
+            target_call_graph=self.call_graphs.get((tb_id,)),
+            similarity_graph=self.similarity_graphs.get((qb_id, tb_id)),
+        )
+
+    def _handle(self, request: Request) -> Response:
+        if isinstance(request, StatsRequest):
+            return self.stats()
+
+        if isinstance(request, NeighBSimRequest):
+            result = neighbsim(
+                request.query_function_id,
+                request.target_function_id,
+                self.neighbsim_args(request.query_binary_id, request.target_binary_id),
+                matching=MatchingOptions(algorithm=request.matching),
+            )
+            return NeighBSimResponse(
+                score=result.score,
+                bsim=result.bsim,
+                caller_matching=_matched_pairs(result.caller_matching, result.qcallers),
+                callee_matching=_matched_pairs(result.callee_matching, result.qcallees),
+                caller_matching_algorithm=result.caller_matching_algorithm,
+                callee_matching_algorithm=result.callee_matching_algorithm,
+                score_error_bound=result.score_error_bound,
+            )
+
+        if isinstance(request, TopKRequest):
+            topk = neighbsim_topk(
+                request.query_function_id,
+                self.neighbsim_args(request.query_binary_id, request.target_binary_id),
+                request.k,
+            )
+            return TopKResponse(
+                target_function_ids=topk.target_function_ids,
+                scores=[result.score for result in topk.results],
+                candidate_count=topk.candidate_count,
+                scored_count=topk.scored_count,
+            )
+
+        if isinstance(request, FirmUPRequest):
+            args = FirmUPArgs(
+                similarity_graph=self.similarity_graphs.get(
+                    (request.query_binary_id, request.target_binary_id)
+                ),
+                query_binary_id=request.query_binary_id,
+                target_binary_id=request.target_binary_id,
+            )
+            try:
+                result = firmup(request.query_function_id, args, max_steps=request.max_steps)
+            except StepLimitReachedError:
+                return FirmUPResponse(match_function_id=None, steps=None, step_limit_reached=True)
+
+            if result is None:
+                return FirmUPResponse(match_function_id=None, steps=None, step_limit_reached=False)
+            return FirmUPResponse(
+                match_function_id=next(iter(result.matching[request.query_function_id])),
+                steps=result.steps,
+                step_limit_reached=False,
+            )
+
+        raise ValueError(f"Unknown request {request}")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "ServiceServer"
+
+    def handle(self):
+        decoder = msgspec.msgpack.Decoder(Request)
+        encoder = msgspec.msgpack.Encoder()
+        while True:
+            message = _read_message(self.rfile)
+            if message is None:
+                return
+
+            try:
+                request = decoder.decode(message)
+            except msgspec.DecodeError as e:
+                response = ErrorResponse(message=f"Invalid request: {e}")
+            else:
+                response = self.server.service.handle(request)
+
+            _write_message(self.wfile, encoder.encode(response))
+
+
+class ServiceServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: pl.Path, service: ScoringService):
+        self.service = service
+        path = pl.Path(path)
+        if path.is_socket():
+            _unlink_stale_socket(path)
+        super().__init__(str(path), _Handler)
+
+    def server_close(self):
+        super().server_close()
+        pl.Path(self.server_address).unlink(missing_ok=True)
+
+
+def _unlink_stale_socket(path: pl.Path):
+    """Removes a socket that is left over from a service that was killed.
+    Raises OSError if a service still listens on the socket.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            path.unlink(missing_ok=True)
+            return
+
+    raise OSError(errno.EADDRINUSE, f"A service is already listening on {path}")
+
+
+def serve(path: pl.Path = DEFAULT_SOCKET_PATH, service: ScoringService | None = None):
+    """Serves until interrupted."""
+    if service is None:
+        service = ScoringService()
+
+    with ServiceServer(path, service) as server:
+        logging.info(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+class ServiceClient:
+    """A client of the scoring service.
+    Can be shared between threads, but requests of a client are sent one after another.
+    Use one client per thread to send requests concurrently.
+    """
+
+    def __init__(self, path: pl.Path = DEFAULT_SOCKET_PATH):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(str(path))
+        self._file = self._socket.makefile("rwb")
+        self._lock = threading.Lock()
+        self._encoder = msgspec.msgpack.Encoder()
+        self._decoder = msgspec.msgpack.Decoder(Response)
+
+    def __enter__(self) -> "ServiceClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def request(self, request: Request) -> Response:
+        """Raises ServiceError if the service answered with an error."""
+        with self._lock:
+            _write_message(self._file, self._encoder.encode(request))
+            message = _read_message(self._file)
+        if message is None:
+            raise ServiceError("The service closed the connection")
+
+        response = self._decoder.decode(message)
+        if isinstance(response, ErrorResponse):
+            raise ServiceError(response.message)
+
+        return response
+
+    def neighbsim(
+        self,
+        query_binary_id: int,
+        target_binary_id: int,
+        query_function_id: int,
+        target_function_id: int,
+    ) -> NeighBSimResponse:
+        """Scores the pair with the exact matching.
+        Send a NeighBSimRequest with request to select another matching algorithm.
+        """
+        return self.request(
+            NeighBSimRequest(
+                query_binary_id=query_binary_id,
+                target_binary_id=target_binary_id,
+                query_function_id=query_function_id,
+                target_function_id=target_function_id,
+            )
+        )
+
+    def firmup(
+        self,
+        query_binary_id: int,
+        target_binary_id: int,
+        query_function_id: int,
+        max_steps: int | None = None,
+    ) -> FirmUPResponse:
+        return self.request(
+            FirmUPRequest(
+                query_binary_id=query_binary_id,
+                target_binary_id=target_binary_id,
+                query_function_id=query_function_id,
+                max_steps=max_steps,
+            )
+        )
+
+    def topk(
+        self,
+        query_binary_id: int,
+        target_binary_id: int,
+        query_function_id: int,
+        k: int,
+    ) -> TopKResponse:
+        return self.request(
+            TopKRequest(
+                query_binary_id=query_binary_id,
+                target_binary_id=target_binary_id,
+                query_function_id=query_function_id,
+                k=k,
+            )
+        )
+
+    def stats(self) -> StatsResponse:
+        return self.request(StatsRequest())
+
+
+def _read_message(f) -> bytes | None:
+    """Returns None if the connection was closed before the message."""
+    header = f.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        return None
+    (length,) = _LENGTH.unpack(header)
+    message = f.read(length)
+    if len(message) < length:
+        return None
+
+    return message
+
+
+def _write_message(f, message: bytes):
+    f.write(_LENGTH.pack(len(message)))
+    f.write(message)
+    f.flush()
+
+
+def _matched_pairs(
+    matching: nx.Graph, query_function_ids: list[int]
+) -> list[tuple[int, int, float]]:
+    query_function_ids = set(query_function_ids)
+    ret = []
+    for u, v, data in matching.edges(data=True):
+        query_id, target_id = (u, v) if u in query_function_ids else (v, u)
+        ret.append((query_id, target_id, data["weight"]))
+
+    return sorted(ret)
+
+
+def _latency_stats(count: int, latencies: np.ndarray) -> LatencyStats:
+    return LatencyStats(
+        count=count,
+        mean=float(latencies.mean()),
+        p50=float(np.quantile(latencies, 0.5)),
+        p99=float(np.quantile(latencies, 0.99)),
+        max=float(latencies.max()),
+    )
@@ -1,36 +1,48 @@
 
+import typing
+
 import networkx as nx
+import numpy as np
 import sqlalchemy as sa
 
-from evaluatie import models as m
+if typing.TYPE_CHECKING:
+    # Importing models requires the configuration file and a database url.
+    # Scoring from a bundle (see evaluatie.bundle) needs neither.
+    from evaluatie import models as m
+
+
+def dataset_table(dataset_name: str) -> str:
+    """Returns the quoted name of the dataset's table in the 'd' schema."""
+    escaped = dataset_name.replace('"', '""')
+    return f'd."{escaped}"'
 
 
-def call_graph_from_binary_id(binary_id: int, session: m.Session) -> nx.DiGraph:
+def call_graph_from_binary_id(binary_id: int, session: "m.Session") -> nx.DiGraph:
     """Returns the GHIDRA call-graph. Nodes that are from evaluatie but not in ghidra are ignored."""
     edges_stmt = sa.text(
-        f"""
+        """
         SELECT src_id, dst_id
         FROM v.call_graph_edge cg
-        WHERE cg.src_binary_id = {binary_id}
+        WHERE cg.src_binary_id = :binary_id
         """
     )
     nodes_stmt = sa.text(
-        f"""
+        """
         SELECT f.id, f.name, f.size
         FROM "function" f
             JOIN v.description2function d2f ON (
                 f.id = d2f.function_id
             )
-        WHERE f.binary_id = {binary_id}
+        WHERE f.binary_id = :binary_id
         """
     )
 
     cg = nx.DiGraph()
 
-    for node, name, size in session.execute(nodes_stmt):
+    for node, name, size in session.execute(nodes_stmt, {"binary_id": binary_id}):
         cg.add_node(node, name=name, size=size)
 
-    for src_id, dst_id in session.execute(edges_stmt):
+    for src_id, dst_id in session.execute(edges_stmt, {"binary_id": binary_id}):
         # Ignore edges that have nodes that we want to ignore
         if src_id not in cg or dst_id not in cg:
             continue
@@ -39,26 +51,55 @@ def call_graph_from_binary_id(binary_id: int, session: m.Session) -> nx.DiGraph:
     return cg
 
 
-def similarity_graph_from_pair(qb_id: int, tb_id: int, session: m.Session) -> nx.Graph:
+def similarity_graph_entries(
+    similarity_graph: nx.Graph,
+    query_function_ids: list[int],
+    target_function_ids: list[int],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the edges of a (bipartite) similarity graph as the positions of the query
+    and target function in the given lists and the similarity.
+    Edges with a function that is not in the lists are left out.
+    """
+    qid2idx = {qid: idx for idx, qid in enumerate(query_function_ids)}
+    tid2idx = {tid: idx for idx, tid in enumerate(target_function_ids)}
+
+    rows = []
+    cols = []
+    weights = []
+    for u, v, weight in similarity_graph.edges(data="weight"):
+        # Edges of an undirected graph have no orientation
+        query_id, target_id = (u, v) if u in qid2idx else (v, u)
+        if query_id not in qid2idx or target_id not in tid2idx:
+            continue
+        rows.append(qid2idx[query_id])
+        cols.append(tid2idx[target_id])
+        weights.append(weight)
+
+    return (
+        np.array(rows, dtype=np.int64),
+        np.array(cols, dtype=np.int64),
+        np.array(weights, dtype=np.float64),
+    )
+
+
+def similarity_graph_from_pair(qb_id: int, tb_id: int, session: "m.Session") -> nx.Graph:
     """Returns the similarity graph of all ghidra and non-ghidra functions.
     Non-ghidra functions will have similarity zero to all comaprisons.
     """
 
     # We need to use e."function:all" here since we need to calculate similarity between all functions
     # in the call-graph, not just the functions that we use in our evaluation.
-    table = "function:all"
-
     stmt = sa.text(
-        f"""
+        """
 WITH qf AS (
 	SELECT *
-	FROM e."{table}" f
-	WHERE f.binary_id = {qb_id}
+	FROM e."function:all" f
+	WHERE f.binary_id = :qb_id
 ),
 tf AS (
 	SELECT *
-	FROM e."{table}" f
-	WHERE f.binary_id = {tb_id}
+	FROM e."function:all" f
+	WHERE f.binary_id = :tb_id
 )
 SELECT qf.id AS qf_id, tf.id AS tf_id, COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0) AS bsim
 FROM qf, tf
@@ -67,16 +108,50 @@ WHERE qf.vector IS NOT NULL AND tf.vector IS NOT NULL
     )
 
     g = nx.Graph()
-    g.add_weighted_edges_from(session.execute(stmt))
+    g.add_weighted_edges_from(session.execute(stmt, {"qb_id": qb_id, "tb_id": tb_id}))
 
     return g
 
-def similarity_graph_from_pair2(qb_id: int, tb_id: int, dataset_name: str, session: m.Session) -> nx.Graph:
+def similarity_graphs_from_query_binary(
+    qb_id: int,
+    tb_ids: list[int],
+    session: "m.Session",
+) -> dict[int, nx.Graph]:
+    """Like similarity_graph_from_pair for every target binary, but with a single statement.
+    The functions of the query binary are read once for all target binaries.
+    """
+    stmt = sa.text(
+        """
+WITH qf AS MATERIALIZED (
+	SELECT f.id, f.vector
+	FROM e."function:all" f
+	WHERE f.binary_id = :qb_id AND f.vector IS NOT NULL
+),
+tf AS (
+	SELECT f.id, f.binary_id, f.vector
+	FROM e."function:all" f
+	WHERE f.binary_id = ANY(:tb_ids) AND f.vector IS NOT NULL
+)
+SELECT tf.binary_id, qf.id AS qf_id, tf.id AS tf_id, COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0) AS bsim
+FROM qf, tf
+"""
+    )
+
+    tb_id2graph = {tb_id: nx.Graph() for tb_id in tb_ids}
+    for tb_id, qf_id, tf_id, bsim in session.execute(stmt, {"qb_id": qb_id, "tb_ids": list(tb_ids)}):
+        tb_id2graph[tb_id].add_edge(qf_id, tf_id, weight=bsim)
+
+    return tb_id2graph
+
+def similarity_graph_from_pair2(qb_id: int, tb_id: int, dataset_name: str, session: "m.Session") -> nx.Graph:
+    # The table name can not be a parameter, but the statement is the same for all
+    # binary pairs of a dataset.
+    table = dataset_table(dataset_name)
     stmt = sa.text(
     f"""
 WITH qf AS (
 	SELECT DISTINCT ON (f.id) f.id, f.binary_id, f.vector
-	FROM d."{dataset_name}"
+	FROM {table}
 		-- outer join to not omit functions that do not have callers/callees
 		LEFT OUTER JOIN e.call_graph_edge qcg ON (
 			query_function_id = qcg.src_id OR
@@ -87,11 +162,11 @@ WITH qf AS (
 			f.id = qcg.src_id OR
 			f.id = qcg.dst_id
 		)
-	WHERE query_binary_id = {qb_id}
+	WHERE query_binary_id = :qb_id
 ),
 tf AS (
 	SELECT DISTINCT ON (f.id) f.id, f.binary_id, f.vector
-	FROM d."{dataset_name}"
+	FROM {table}
 		LEFT OUTER JOIN e.call_graph_edge tcg ON (
 			ptarget_function_id = tcg.src_id OR
 			ptarget_function_id = tcg.dst_id OR
@@ -104,13 +179,43 @@ tf AS (
 			f.id = tcg.src_id OR
 			f.id = tcg.dst_id
 		)
-	WHERE target_binary_id = {tb_id}
+	WHERE target_binary_id = :tb_id
 )
 SELECT qf.id, tf.id, COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0) AS bsim
 FROM qf, tf;
     """)
 
     g = nx.Graph()
-    g.add_weighted_edges_from(session.execute(stmt))
+    g.add_weighted_edges_from(session.execute(stmt, {"qb_id": qb_id, "tb_id": tb_id}))
+
+    return g
+
+
+def similarity_graph_from_function_ids(
+    query_function_ids: list[int],
+    target_function_ids: list[int],
+    session: "m.Session",
+) -> nx.Graph:
+    """Returns the full bipartite similarity graph between the given functions.
+    Functions without a vector have similarity zero to all other functions.
+    """
+    stmt = sa.text(
+        """
+SELECT qf.id, tf.id, COALESCE((lshvector_compare(qf.vector, tf.vector)).sim, 0) AS bsim
+FROM e."function:all" qf, e."function:all" tf
+WHERE qf.id = ANY(:query_function_ids) AND tf.id = ANY(:target_function_ids)
+"""
+    )
+
+    g = nx.Graph()
+    g.add_weighted_edges_from(
+        session.execute(
+            stmt,
+            {
+                "query_function_ids": list(query_function_ids),
+                "target_function_ids": list(target_function_ids),
+            },
+        )
+    )
 
     return g
@@ -0,0 +1,422 @@
+# SPDX-FileCopyrightText: 2024 Marten Ringwelski
+# SPDX-FileContributor: Marten Ringwelski <git@maringuu.de>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+
+import msgspec
+import networkx as nx
+import pandas as pd
+import sqlalchemy as sa
+
+from evaluatie import models as m
+from evaluatie import scoring, utils
+from evaluatie.firmup.firmup import StepLimitReachedError, firmup, firmup_args_from_binary_ids
+from evaluatie.neighbsim.matching import MatchingMemo
+from evaluatie.neighbsim.neighbsim import neighbsim
+
+METHODS = ["neighbsim", "firmup"]
+
+
+class Job(msgspec.Struct, frozen=True):
+    id: int
+    query_binary_id: int
+    target_binary_id: int
+    dataset: str
+    method: str
+
+
+class WorkerStatus(msgspec.Struct, frozen=True):
+    worker: str
+    running: int
+    done: int
+    failed: int
+    #: Jobs and results that were finished in the status window
+    recent_jobs: int
+    recent_rows: int
+    #: Results per second in the status window
+    throughput: float
+
+
+class WorkerOptions(msgspec.Struct, frozen=True):
+    #: Defaults to default_worker_name()
+    worker: str | None = None
+    lease: datetime.timedelta = datetime.timedelta(minutes=5)
+    #: How often a job is claimed before it is marked as failed
+    max_attempts: int = 3
+    #: The step limit for firmup
+    max_steps: int | None = None
+    #: If set, waits for new jobs instead of returning on an empty queue
+    poll_interval: float | None = None
+    max_jobs: int | None = None
+
+
+def default_worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue(dataset: str, method: str, session: m.Session) -> int:
+    """Creates a pending job for every binary pair of the dataset.
+    Returns the amount of newly created jobs.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method}. Must be one of {METHODS}")
+
+    stmt = sa.text(
+        f"""
+        INSERT INTO scoring_job (query_binary_id, target_binary_id, dataset, method, status, attempts)
+        SELECT DISTINCT query_binary_id, target_binary_id, :dataset, :method, 'pending', 0
+        FROM {utils.dataset_table(dataset)}
+        ON CONFLICT DO NOTHING
+        """
+    )
+    result = session.execute(stmt, {"dataset": dataset, "method": method})
+    session.commit()
+
+    return result.rowcount
+
+
+def claim(
+    worker: str,
+    lease: datetime.timedelta,
+    max_attempts: int,
+    session: m.Session,
+) -> Job | None:
+    """Claims the oldest job that is pending or whose lease expired.
+    SKIP LOCKED lets any number of workers on any host claim jobs concurrently.
+    Jobs whose lease expired after max_attempts claims (e.g. because they crash their
+    worker every time) are marked as failed instead of being claimed again.
+    """
+    expire_stmt = sa.text(
+        """
+        UPDATE scoring_job
+        SET status = 'failed',
+            finished_at = now(),
+            error = 'Lease expired after ' || attempts || ' attempts'
+        WHERE status = 'running' AND lease_expires_at < now() AND attempts >= :max_attempts
+        """
+    )
+    session.execute(expire_stmt, {"max_attempts": max_attempts})
+
+    stmt = sa.text(
+        """
+        UPDATE scoring_job
+        SET status = 'running',
+            worker = :worker,
+            attempts = attempts + 1,
+            started_at = now(),
+            heartbeat_at = now(),
+            lease_expires_at = now() + :lease
+        WHERE id = (
+            SELECT id
+            FROM scoring_job
+            WHERE status = 'pending'
+                OR (
+                    status = 'running'
+                    AND lease_expires_at < now()
+                    AND attempts < :max_attempts
+                )
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, query_binary_id, target_binary_id, dataset, method
+        """
+    )
+    row = session.execute(
+        stmt,
+        {"worker": worker, "lease": lease, "max_attempts": max_attempts},
+    ).one_or_none()
+    session.commit()
+
+    if row is None:
+        return None
+
+    return Job(*row)
+
+
+def heartbeat(job: Job, worker: str, lease: datetime.timedelta, session: m.Session) -> bool:
+    """Renews the lease of the job.
+    Returns False if the worker does not own the job anymore.
+    """
+    stmt = sa.text(
+        """
+        UPDATE scoring_job
+        SET heartbeat_at = now(), lease_expires_at = now() + :lease
+        WHERE id = :id AND worker = :worker AND status = 'running'
+        """
+    )
+    result = session.execute(stmt, {"id": job.id, "worker": worker, "lease": lease})
+    session.commit()
+
+    return result.rowcount == 1
+
+
+def complete(job: Job, worker: str, rows: list[dict], session: m.Session) -> bool:
+    """Writes the results in bulk and marks the job as done in a single transaction.
+    Returns False (and writes nothing) if the worker does not own the job anymore.
+    """
+    stmt = sa.text(
+        """
+        UPDATE scoring_job
+        SET status = 'done', finished_at = now(), row_count = :row_count, error = NULL
+        WHERE id = :id AND worker = :worker AND status = 'running'
+        """
+    )
+    result = session.execute(stmt, {"id": job.id, "worker": worker, "row_count": len(rows)})
+    if result.rowcount != 1:
+        session.rollback()
+        return False
+
+    session.execute(sa.delete(m.ScoringResult).where(m.ScoringResult.job_id == job.id))
+    if len(rows) != 0:
+        session.execute(
+            sa.insert(m.ScoringResult),
+            [{"job_id": job.id, **row} for row in rows],
+        )
+    session.commit()
+
+    return True
+
+
+def fail(job: Job, worker: str, error: str, max_attempts: int, session: m.Session):
+    """Marks the job as failed, or as pending if it has attempts left."""
+    stmt = sa.text(
+        """
+        UPDATE scoring_job
+        SET status = CASE WHEN attempts < :max_attempts THEN 'pending' ELSE 'failed' END,
+            finished_at = now(),
+            error = :error
+        WHERE id = :id AND worker = :worker AND status = 'running'
+        """
+    )
+    session.execute(
+        stmt,
+        {"id": job.id, "worker": worker, "error": error, "max_attempts": max_attempts},
+    )
+    session.commit()
+
+
+def score(job: Job, session: m.Session, max_steps: int | None = None) -> list[dict]:
+    """Scores all rows of the job's binary pair.
+    Returns the rows for the scoring_result table (without job_id).
+    """
+    stmt = sa.text(
+        f"""
+        SELECT query_function_id, ptarget_function_id, ntarget_function_id
+        FROM {utils.dataset_table(job.dataset)}
+        WHERE query_binary_id = :query_binary_id AND target_binary_id = :target_binary_id
+        """
+    )
+    frame = pd.DataFrame(
+        session.execute(
+            stmt,
+            {
+                "query_binary_id": job.query_binary_id,
+                "target_binary_id": job.target_binary_id,
+            },
+        ).all(),
+        columns=["query_function_id", "ptarget_function_id", "ntarget_function_id"],
+    )
+
+    if job.method == "neighbsim":
+        return _score_neighbsim(job, frame, session)
+    if job.method == "firmup":
+        return _score_firmup(job, frame, max_steps, session)
+
+    raise ValueError(f"Unknown method {job.method}")
+
+
+def _score_neighbsim(job: Job, frame: pd.DataFrame, session: m.Session) -> list[dict]:
+    rows = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "query_function_id": frame["query_function_id"],
+                    "target_function_id": frame[column],
+                    "label": label,
+                }
+            )
+            for column, label in [("ptarget_function_id", True), ("ntarget_function_id", False)]
+        ],
+        ignore_index=True,
+    ).drop_duplicates(subset=["query_function_id", "target_function_id"])
+
+    args = scoring.neighbsim_args_for_rows(
+        job.query_binary_id,
+        job.target_binary_id,
+        rows,
+        scoring.DatabaseSource(session),
+    )
+
+    memo = MatchingMemo()
+    ret = []
+    for query_function_id, target_function_id, label in rows.itertuples(index=False):
+        qf_id = int(query_function_id)
+        tf_id = int(target_function_id)
+        # Rows that cannot be scored are kept unscored, like in scoring.execute_plan
+        try:
+            score = neighbsim(qf_id, tf_id, args, memo=memo).score
+        except nx.NetworkXError as e:
+            logging.warning(f"Job {job.id}: Could not score ({qf_id}, {tf_id}): {e}")
+            score = None
+        ret.append(
+            {
+                "query_function_id": qf_id,
+                "target_function_id": tf_id,
+                "label": bool(label),
+                "score": score,
+            }
+        )
+
+    return ret
+
+
+def _score_firmup(
+    job: Job,
+    frame: pd.DataFrame,
+    max_steps: int | None,
+    session: m.Session,
+) -> list[dict]:
+    args = firmup_args_from_binary_ids(job.query_binary_id, job.target_binary_id, session)
+
+    ret = []
+    for qf_id in frame["query_function_id"].unique().tolist():
+        row = {
+            "query_function_id": qf_id,
+            "target_function_id": None,
+            "steps": None,
+        }
+        try:
+            result = firmup(qf_id, args, max_steps=max_steps)
+        except StepLimitReachedError:
+            result = None
+
+        if result is not None:
+            row["target_function_id"] = next(iter(result.matching[qf_id]))
+            row["steps"] = result.steps
+        ret.append(row)
+
+    return ret
+
+
+class _Heartbeat(threading.Thread):
+    """Renews the lease of a job in the background, until stopped."""
+
+    def __init__(self, job: Job, worker: str, lease: datetime.timedelta):
+        super().__init__(daemon=True)
+        self.job = job
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+        #: Set if the worker lost the job to another worker
+        self.lost = threading.Event()
+
+    def run(self):
+        interval = self.lease.total_seconds() / 3
+        with m.Session() as session:
+            while not self.stopped.wait(interval):
+                try:
+                    owned = heartbeat(self.job, self.worker, self.lease, session)
+                except sa.exc.SQLAlchemyError as e:
+                    logging.warning(f"Heartbeat for job {self.job.id} failed: {e}")
+                    session.rollback()
+                    continue
+                if not owned:
+                    self.lost.set()
+                    return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def work(options: WorkerOptions = WorkerOptions()) -> int:
+    """Claims and scores jobs until the queue is empty.
+    While a job is scored, its lease is renewed by heartbeats. If the worker crashes,
+    the lease expires and the job is claimed by another worker.
+    If options.poll_interval is set, waits for new jobs instead of returning.
+    Returns the amount of completed jobs.
+    """
+    worker = options.worker if options.worker is not None else default_worker_name()
+
+    completed = 0
+    with m.Session() as session:
+        while options.max_jobs is None or completed < options.max_jobs:
+            job = claim(worker, options.lease, options.max_attempts, session)
+            if job is None:
+                if options.poll_interval is None:
+                    break
+                time.sleep(options.poll_interval)
+                continue
+
+            logging.info(f"{worker} claimed job {job.id} ({job.dataset}, {job.method})")
+            hb = _Heartbeat(job, worker, options.lease)
+            hb.start()
+            try:
+                rows = score(job, session, max_steps=options.max_steps)
+            except Exception as e:
+                hb.stop()
+                session.rollback()
+                logging.exception(f"Job {job.id} failed")
+                fail(job, worker, repr(e), options.max_attempts, session)
+                continue
+            hb.stop()
+
+            if hb.lost.is_set() or not complete(job, worker, rows, session):
+                logging.warning(f"{worker} lost job {job.id} to another worker")
+                continue
+
+            completed += 1
+
+    return completed
+
+
+def status(
+    session: m.Session,
+    window: datetime.timedelta = datetime.timedelta(minutes=10),
+) -> tuple[dict[str, int], list[WorkerStatus]]:
+    """Returns the amount of jobs per status and statistics for every worker."""
+    status2count = dict(
+        session.execute(
+            sa.text("SELECT status, COUNT(*) FROM scoring_job GROUP BY status")
+        ).all()
+    )
+
+    stmt = sa.text(
+        """
+        SELECT
+            worker,
+            COUNT(*) FILTER (WHERE status = 'running'),
+            COUNT(*) FILTER (WHERE status = 'done'),
+            COUNT(*) FILTER (WHERE status = 'failed'),
+            COUNT(*) FILTER (WHERE status = 'done' AND finished_at > now() - :window),
+            COALESCE(SUM(row_count) FILTER (WHERE status = 'done' AND finished_at > now() - :window), 0)
+        FROM scoring_job
+        WHERE worker IS NOT NULL
+        GROUP BY worker
+        ORDER BY worker
+        """
+    )
+    workers = [
+        WorkerStatus(
+            worker=worker,
+            running=running,
+            done=done,
+            failed=failed,
+            recent_jobs=recent_jobs,
+            recent_rows=recent_rows,
+            throughput=recent_rows / window.total_seconds(),
+        )
+        for worker, running, done, failed, recent_jobs, recent_rows in session.execute(
+            stmt, {"window": window}
+        )
+    ]
+
+    return status2count, workers